@@ -0,0 +1,74 @@
+import asyncio
+import time
+
+__all__ = ['PeerBatcher', 'BatchNotSupported']
+
+
+class BatchNotSupported(Exception):
+    """
+    The peer has no batch endpoint, e.g. it runs an older version.
+    """
+
+
+class PeerBatcher:
+    """
+    Collects requests to the same peer for `window` seconds, or until `max_size` requests,
+    and sends them in one batch request, so that per-request overhead is shared by many files.
+    Peers without the batch endpoint are remembered for UNSUPPORTED_TTL seconds,
+    callers check `supports(ip)` and fall back to single requests.
+    """
+    UNSUPPORTED_TTL = 60 * 60  # seconds
+
+    def __init__(self, send, window, max_size) -> None:
+        """
+        :param send: coroutine function taking a peer ip and a list of items,
+            returns results in the order of the items, raises BatchNotSupported
+        :param window: <float> seconds to wait for more requests to the same peer
+        :param max_size: <int> max items in a batch
+        """
+        self._send = send
+        self._window = window
+        self._max_size = max_size
+        self._queues = {}  # ip -> [(item, future)]
+        self._timers = {}  # ip -> flush timer
+        self._unsupported = {}  # ip -> time of the failed batch
+
+    def supports(self, ip) -> bool:
+        failed_at = self._unsupported.get(ip)
+        return failed_at is None or time.monotonic() - failed_at > self.UNSUPPORTED_TTL
+
+    async def request(self, ip, item):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        queue = self._queues.setdefault(ip, [])
+        queue.append((item, future))
+        if len(queue) >= self._max_size:
+            self._flush(ip)
+        elif ip not in self._timers:
+            self._timers[ip] = loop.call_later(self._window, self._flush, ip)
+        return await future
+
+    def _flush(self, ip):
+        timer = self._timers.pop(ip, None)
+        if timer:
+            timer.cancel()
+        queue = self._queues.pop(ip, [])
+        if queue:
+            asyncio.ensure_future(self._send_batch(ip, queue))
+
+    async def _send_batch(self, ip, queue):
+        try:
+            results = await self._send(ip, [item for item, _ in queue])
+            if len(results) != len(queue):
+                raise ValueError(f'Invalid batch response | expected: {len(queue)} results | got: {len(results)}')
+        except Exception as err:
+            if isinstance(err, BatchNotSupported):
+                self._unsupported[ip] = time.monotonic()
+            for _, future in queue:
+                if not future.done():
+                    future.set_exception(err)
+            return
+        self._unsupported.pop(ip, None)
+        for (_, future), result in zip(queue, results):
+            if not future.done():
+                future.set_result(result)
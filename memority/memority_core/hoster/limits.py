@@ -0,0 +1,79 @@
+import asyncio
+
+from settings import settings
+
+__all__ = ['ResourceLimits', 'monitoring_limits']
+
+
+class _Resource:
+    """
+    Async context manager holding one of `limit` slots, waiters are served in FIFO order.
+    """
+
+    def __init__(self, limit) -> None:
+        self.limit = limit
+        self._semaphore = asyncio.Semaphore(limit)
+        self.in_flight = 0
+        self.waiting = 0
+        self.peak_waiting = 0
+        self.completed = 0
+
+    async def __aenter__(self):
+        self.waiting += 1
+        self.peak_waiting = max(self.peak_waiting, self.waiting)
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.in_flight -= 1
+        self.completed += 1
+        self._semaphore.release()
+
+    def stats(self) -> dict:
+        return {
+            "limit": self.limit,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "peak_waiting": self.peak_waiting,
+            "completed": self.completed,
+        }
+
+
+class ResourceLimits:
+    """
+    Concurrency limits of monitoring work per resource class, e.g. `async with limits['rpc']: ...`.
+    New monitoring passes are deferred while the queue of any class is longer than max_queue,
+    so that a large hoster does not pile up thousands of waiting requests.
+    """
+
+    def __init__(self, limits: dict, max_queue: int) -> None:
+        self._resources = {name: _Resource(limit) for name, limit in limits.items()}
+        self.max_queue = max_queue
+        self.deferred = 0  # saturation checks that deferred a monitoring pass
+
+    def __getitem__(self, name) -> _Resource:
+        return self._resources[name]
+
+    def saturated(self) -> bool:
+        return any(r.waiting >= self.max_queue for r in self._resources.values())
+
+    def stats(self) -> dict:
+        return {
+            "max_queue": self.max_queue,
+            "deferred": self.deferred,
+            **{name: r.stats() for name, r in self._resources.items()},
+        }
+
+
+monitoring_limits = ResourceLimits(
+    {
+        'http': settings.monitoring_http_concurrency,  # proofs, statuses and uploads to other hosters
+        'rpc': settings.monitoring_rpc_concurrency,  # contract calls and transactions
+        'disk': settings.monitoring_disk_concurrency,  # hashing of own file bodies
+    },
+    max_queue=settings.monitoring_max_queue
+)
@@ -0,0 +1,143 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import math
+import random
+import time
+from contextlib import suppress
+
+__all__ = ['MonitoringScheduler']
+
+logger = logging.getLogger('monitoring')
+
+
+class MonitoringScheduler:
+    """
+    Monitoring passes of all hosted files in one heap keyed by the next due time.
+    Adding or removing a file is O(log n), removed entries are skipped lazily when they reach the top.
+    Each file is monitored every `interval` seconds in the slot of its monitoring number,
+    so that the hosters of a file do not check each other at the same time.
+    At most `workers` passes run at once, due files wait in the heap meanwhile.
+    New passes are also deferred while the resource limits are saturated.
+    With a `tick`, due times are rounded up to whole ticks, so that passes start in groups
+    and their proof requests to the same hosters can be batched.
+    """
+    DEFER_DELAY = 1.0  # seconds between saturation checks
+
+    def __init__(self, monitor, interval, slots, workers, limits=None, tick=0) -> None:
+        """
+        :param monitor: coroutine function taking a file hash, returns False if the file is gone
+        :param interval: <int> seconds between monitoring passes of a file
+        :param slots: <int> number of monitoring slots in the interval, one per hoster of a file
+        :param workers: <int> max monitoring passes at once
+        :param limits: <ResourceLimits> resource limits of monitoring passes, optional
+        :param tick: <int> seconds, due times are rounded up to whole ticks, 0 to disable
+        """
+        self._monitor = monitor
+        self._interval = interval
+        self._slot = interval / slots
+        self._workers = asyncio.Semaphore(workers)
+        self._limits = limits
+        self._tick = tick
+        self._heap = []  # [due, seq, file hash or None if removed]
+        self._entries = {}  # file hash -> heap entry
+        self._counter = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._running = 0
+        self._task = None
+
+    def add(self, file_hash, monitoring_number=0):
+        """
+        Schedule the first pass of a file in its slot, or move an already scheduled file there.
+        """
+        offset = ((monitoring_number or 0) + random.random()) * self._slot
+        self._push(file_hash, time.time() + offset)
+
+    def remove(self, file_hash):
+        entry = self._entries.pop(file_hash, None)
+        if entry:
+            entry[2] = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        return {
+            "scheduled": len(self._entries),
+            "running": self._running,
+            "next_due_in": max(0, int(self._heap[0][0] - time.time())) if self._heap else None,
+            **({"limits": self._limits.stats()} if self._limits else {}),
+        }
+
+    def start(self, load=None):
+        """
+        :param load: coroutine function returning [(file hash, monitoring number)] scheduled before the loop starts
+        """
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run(load))
+        return self._task
+
+    def stop(self):
+        if self._task:
+            self._task.cancel()
+
+    def _push(self, file_hash, due):
+        self.remove(file_hash)
+        if self._tick:
+            due = math.ceil(due / self._tick) * self._tick
+        entry = [due, next(self._counter), file_hash]
+        self._entries[file_hash] = entry
+        heapq.heappush(self._heap, entry)
+        if self._heap[0] is entry:
+            self._wakeup.set()
+
+    async def _run(self, load):
+        if load:
+            for file_hash, monitoring_number in await load():
+                self.add(file_hash, monitoring_number)
+            logger.info(f'Monitoring scheduled | files: {len(self)}')
+        while True:
+            await self._workers.acquire()
+            try:
+                await self._wait_unsaturated()
+                due, file_hash = await self._next_due()
+            except BaseException:
+                self._workers.release()
+                raise
+            asyncio.ensure_future(self._run_pass(file_hash, due))
+
+    async def _wait_unsaturated(self):
+        if not (self._limits and self._limits.saturated()):
+            return
+        logger.warning(f'Monitoring deferred, resource queues are full | limits: {self._limits.stats()}')
+        while self._limits.saturated():
+            self._limits.deferred += 1
+            await asyncio.sleep(self.DEFER_DELAY)
+        logger.info('Monitoring resumed')
+
+    async def _next_due(self):
+        while True:
+            while self._heap and self._heap[0][2] is None:
+                heapq.heappop(self._heap)
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            if timeout is not None and timeout <= 0:
+                due, _, file_hash = heapq.heappop(self._heap)
+                del self._entries[file_hash]
+                return due, file_hash
+            self._wakeup.clear()
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+
+    async def _run_pass(self, file_hash, due):
+        self._running += 1
+        keep = True
+        try:
+            keep = await self._monitor(file_hash) is not False
+        except Exception as err:
+            logger.error(f'Monitoring failed | file: {file_hash} | message: {err.__class__.__name__} {str(err)}')
+        finally:
+            self._running -= 1
+            self._workers.release()
+        if keep and file_hash not in self._entries:  # not rescheduled with add() meanwhile
+            self._push(file_hash, max(due + self._interval, time.time()))
@@ -1,6 +1,8 @@
 from aiohttp import web
 
 from bugtracking import raven_client
+from models import unit_of_work
+from utils import setup_peer_session
 from .tasks import create_scheduler
 from .views import *
 
@@ -23,15 +25,25 @@ async def error_middleware(request, handler):
         }, status=500)
 
 
+@web.middleware
+async def unit_of_work_middleware(request, handler):
+    async with unit_of_work():
+        return await handler(request)
+
+
 def create_hoster_app():
-    app = web.Application(middlewares=[error_middleware])
+    app = web.Application(middlewares=[error_middleware, unit_of_work_middleware])
     app['scheduler'] = create_scheduler()
+    setup_peer_session(app)
     app.router.add_get('/files/', file_list)
     app.router.add_post('/files/', create_metadata)
+    app.router.add_post('/files/proofs/', batch_proof)
     app.router.add_get('/files/{id}/', get_file)
     app.router.add_put('/files/{id}/', load_body)
     app.router.add_get('/files/{id}/proof/', proof)
+    app.router.add_get('/files/{id}/merkle_proof/', merkle_proof)
     app.router.add_put('/files/{id}/metadata/', final_metadata)
     app.router.add_get('/files/{id}/{host}/status/', file_host_status)
+    app.router.add_post('/files/statuses/', batch_file_host_status)
 
     return app
@@ -1,36 +1,50 @@
 import asyncio
 import logging
 import random
-from contextlib import redirect_stdout, suppress
-from datetime import datetime
 from typing import Any
 
-import aiohttp
-from apscheduler.schedulers import SchedulerAlreadyRunningError
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
-from models import HosterFile, HosterFileM2M, Host
+from models import HosterFile, HosterFileM2M, Host, unit_of_work, commit_async
 from renter.views import upload_to_hoster
 from settings import settings
 from smart_contracts import token_contract
+from utils import get_peer_session
+from .batching import PeerBatcher, BatchNotSupported
+from .limits import monitoring_limits
+from .scheduler import MonitoringScheduler
 
 logger = logging.getLogger('monitoring')
-logger.write = lambda msg: logger.info(msg) if msg != '\n' else None  # for redirect_stdout
+
+MONITORING_INTERVAL = 8 * 60 * 60  # 3x monitoring per day
 
 
 async def request_payment_for_file(file: HosterFile):
     logger.info(f'Requesting payment for file | file: {file.hash}')
-    if token_contract.time_to_pay(file.hash):
-        if await token_contract.get_deposit(file.client_contract_address, file.hash):
-            amount = token_contract.request_payout(file.client_contract_address, file.hash)
-            logger.info(f'Successfully requested payment for file | file: {file.hash} | amount: {amount}')
+    async with monitoring_limits['rpc']:
+        if await token_contract.time_to_pay(file.hash):
+            if await token_contract.get_deposit(
+                    owner_contract_address=file.client_contract_address,
+                    file_hash=file.hash):
+                amount = await token_contract.request_payout(file.client_contract_address, file.hash)
+                logger.info(f'Successfully requested payment for file | file: {file.hash} | amount: {amount}')
 
 
 async def request_payment_for_all_files():
-    for file in HosterFile.objects.all():
-        asyncio.ensure_future(
-            request_payment_for_file(file)
-        )
+    async with unit_of_work():
+        files = await HosterFile.objects.all_async()
+    files = iter(files)
+
+    async def worker():
+        # a few workers instead of a task per file, so payments do not flood the rpc queue
+        for file in files:
+            try:
+                await request_payment_for_file(file)
+            except Exception as err:
+                logger.error(f'Payment request failed | file: {file.hash} '
+                             f'| message: {err.__class__.__name__} {str(err)}')
+
+    await asyncio.gather(*[worker() for _ in range(monitoring_limits['rpc'].limit)])
 
 
 async def get_file_proof_from_hoster(file_host: HosterFileM2M, from_, to_) -> (HosterFileM2M, Any):
@@ -38,8 +52,8 @@ async def get_file_proof_from_hoster(file_host: HosterFileM2M, from_, to_) -> (H
     ip = file_host.host.ip
     hash_ = file_host.file.hash
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f'http://{ip}/files/{hash_}/proof/?from={from_}&to={to_}') as resp:
+        async with monitoring_limits['http']:
+            async with get_peer_session().get(f'http://{ip}/files/{hash_}/proof/?from={from_}&to={to_}') as resp:
                 if not resp.status == 200:
                     raise Exception(f'{resp.status} != 200')
                 resp_data = await resp.json()
@@ -54,6 +68,101 @@ async def get_file_proof_from_hoster(file_host: HosterFileM2M, from_, to_) -> (H
         return file_host, None
 
 
+async def get_file_merkle_proof_from_hoster(file_host: HosterFileM2M, leaves) -> (HosterFileM2M, Any):
+    logger.info(f'Requesting file Merkle proof from hoster '
+                f'| file: {file_host.file.hash} | host: {file_host.host.address}')
+    ip = file_host.host.ip
+    hash_ = file_host.file.hash
+    try:
+        async with monitoring_limits['http']:
+            async with get_peer_session().get(
+                    f'http://{ip}/files/{hash_}/merkle_proof/?leaves={",".join(str(leaf) for leaf in leaves)}'
+            ) as resp:
+                if not resp.status == 200:
+                    raise Exception(f'{resp.status} != 200')
+                resp_data = await resp.json()
+                proofs = resp_data.get('data').get('proofs')
+                logger.info(f'Successfully requested file Merkle proof '
+                            f'| file: {file_host.file.hash} '
+                            f'| host: {file_host.host.address}')
+                return file_host, proofs
+    except Exception as err:
+        logger.warning(f'Error while requesting file Merkle proof | file: {file_host.file.hash} '
+                       f'| host: {file_host.host.address} | message: {err.__class__.__name__} {str(err)}')
+        return file_host, None
+
+
+async def get_file_proofs_from_hoster(ip, challenges) -> list:
+    """
+    :param challenges: [{"hash", "from", "to"}] or [{"hash", "leaves"}], see hoster.views.batch_proof
+    :raise BatchNotSupported: the hoster has no batch proof endpoint
+    """
+    logger.info(f'Requesting file proofs from hoster | hoster ip: {ip} | challenges: {len(challenges)}')
+    async with monitoring_limits['http']:
+        async with get_peer_session().post(f'http://{ip}/files/proofs/', json={"challenges": challenges}) as resp:
+            if resp.status in (404, 405):
+                raise BatchNotSupported(f'{resp.status}')
+            if not resp.status == 200:
+                raise Exception(f'{resp.status} != 200')
+            resp_data = await resp.json()
+    return resp_data.get('data').get('results')
+
+
+# Proof challenges of concurrent monitoring passes, grouped by hoster ip.
+proof_batcher = PeerBatcher(
+    get_file_proofs_from_hoster,
+    window=settings.peer_batch_window,
+    max_size=settings.peer_batch_size
+)
+
+
+async def check_file_host_batched(file: HosterFile, file_host: HosterFileM2M, leaves, from_, to_,
+                                  get_my_proof) -> (HosterFileM2M, Any):
+    """
+    :return: file host, ok or None if the batch request failed or the hoster does not support it
+    """
+    if settings.storage_proof_mode == 'merkle':
+        challenge = {"hash": file.hash, "leaves": leaves}
+    else:
+        challenge = {"hash": file.hash, "from": from_, "to": to_}
+    try:
+        result = await proof_batcher.request(file_host.host.ip, challenge)
+    except BatchNotSupported:
+        logger.info(f'Hoster does not support batch proofs | host: {file_host.host.address}')
+        return file_host, None
+    except Exception as err:  # the whole batch failed, not this file: fall back to a single request
+        logger.warning(f'Error while requesting file proofs | file: {file.hash} '
+                       f'| host: {file_host.host.address} | message: {err.__class__.__name__} {str(err)}')
+        return file_host, None
+    if not isinstance(result, dict) or 'error' in result:
+        logger.warning(f'Error while requesting file proof | file: {file.hash} '
+                       f'| host: {file_host.host.address} | message: {result}')
+        return file_host, False
+    if 'proofs' in result:
+        async with monitoring_limits['disk']:
+            return file_host, await file.verify_merkle_proofs(leaves, result['proofs'])
+    return file_host, result.get('hash') is not None and result['hash'] == await get_my_proof()
+
+
+async def check_file_host(file: HosterFile, file_host: HosterFileM2M, leaves, from_, to_,
+                          get_my_proof) -> (HosterFileM2M, bool):
+    """
+    Batched proof if enabled and supported by the hoster, then
+    Merkle proof if enabled, with fallback to range hash proof for hosters without Merkle support.
+    """
+    if settings.peer_batching and proof_batcher.supports(file_host.host.ip):
+        _, ok = await check_file_host_batched(file, file_host, leaves, from_, to_, get_my_proof)
+        if ok is not None:
+            return file_host, ok
+    if settings.storage_proof_mode == 'merkle':
+        _, proofs = await get_file_merkle_proof_from_hoster(file_host, leaves)
+        if proofs is not None:
+            async with monitoring_limits['disk']:
+                return file_host, await file.verify_merkle_proofs(leaves, proofs)
+    _, proof = await get_file_proof_from_hoster(file_host, from_, to_)
+    return file_host, proof == await get_my_proof()
+
+
 async def upload_file_to_new_host(file: HosterFile, new_host, replacing=None):
     ip = new_host.ip
     logger.info(f'Uploading file to new host | file: {file.hash} | hoster ip: {ip}')
@@ -66,22 +175,33 @@ async def upload_file_to_new_host(file: HosterFile, new_host, replacing=None):
         "hosts": [host.address for host in file.hosts],
         "replacing": replacing.host.address if replacing else None,
     }
-    _, ok = await upload_to_hoster(
-        hoster=new_host,
-        data=data,
-        file=file,
-        _logger=logger
-    )
+    replaced_ids = (replacing.file_id, replacing.host_id) if replacing else None
+    async with monitoring_limits['http']:
+        _, ok = await upload_to_hoster(
+            hoster=new_host,
+            data=data,
+            file=file,
+            _logger=logger
+        )
     if ok and replacing:
-        replacing.delete()
+        # may run after the monitoring pass has ended, the row is loaded again in the own unit of work
+        async with unit_of_work():
+            try:
+                replaced = await HosterFileM2M.objects.get_async(file_id=replaced_ids[0], host_id=replaced_ids[1])
+            except HosterFileM2M.NotFound:
+                pass
+            else:
+                await replaced.delete_async()
     logger.info(f'Uploaded file to new host | file: {file.hash} | hoster ip: {ip} | ok: {ok}')
     # ToDo: select other host and retry if not ok
 
 
 async def get_file_status_from_hoster(hash_: str, host_to_check_address: str, host: Host):
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f'http://{host.ip}/files/{hash_}/{host_to_check_address}/status/') as resp:
+        async with monitoring_limits['http']:
+            async with get_peer_session().get(
+                    f'http://{host.ip}/files/{hash_}/{host_to_check_address}/status/'
+            ) as resp:
                 resp_data = await resp.json()
                 if not resp.status == 200:
                     raise Exception(f'{resp.status} != 200')
@@ -97,42 +217,132 @@ async def get_file_status_from_hoster(hash_: str, host_to_check_address: str, ho
         return None
 
 
+async def get_file_statuses_from_hoster(ip, pairs) -> list:
+    """
+    :param pairs: [{"hash", "host"}], see hoster.views.batch_file_host_status
+    :raise BatchNotSupported: the hoster has no batch status endpoint
+    """
+    logger.info(f'Requesting file host statuses from hoster | hoster ip: {ip} | pairs: {len(pairs)}')
+    async with monitoring_limits['http']:
+        async with get_peer_session().post(f'http://{ip}/files/statuses/', json={"pairs": pairs}) as resp:
+            if resp.status in (404, 405):
+                raise BatchNotSupported(f'{resp.status}')
+            if not resp.status == 200:
+                raise Exception(f'{resp.status} != 200')
+            resp_data = await resp.json()
+    return resp_data.get('data').get('results')
+
+
+# Status requests of concurrent offline votes, grouped by hoster ip.
+status_batcher = PeerBatcher(
+    get_file_statuses_from_hoster,
+    window=settings.peer_batch_window,
+    max_size=settings.peer_batch_size
+)
+
+
+async def get_file_host_status(hash_: str, host_to_check_address: str, host: Host):
+    """
+    Batched request if enabled and supported by the hoster, single request otherwise.
+    """
+    if settings.peer_batching and status_batcher.supports(host.ip):
+        try:
+            result = await status_batcher.request(host.ip, {"hash": hash_, "host": host_to_check_address})
+        except BatchNotSupported:
+            logger.info(f'Hoster does not support batch statuses | host: {host.address}')
+        except Exception as err:  # the whole batch failed, fall back to a single request
+            logger.warning(f'Error while requesting file host status | file: {hash_} '
+                           f'| host: {host.address} | message: {err.__class__.__name__} {str(err)}')
+        else:
+            return result.get('status') if isinstance(result, dict) else None
+    return await get_file_status_from_hoster(hash_, host_to_check_address, host)
+
+
+async def vote_offline_hosts(file: HosterFile, suspected: list):
+    """
+    Ask the other hosters of the file for the statuses of suspected hosts, all at once
+    so that the requests to each hoster are batched, and vote offline the ones most hosters agree on.
+    """
+    file_hosts = await file.get_file_hosts_async()
+    statuses = await asyncio.gather(*[
+        get_file_host_status(
+            hash_=file.hash,
+            host_to_check_address=file_host.host.address,
+            host=fh.host
+        )
+        for file_host in suspected
+        for fh in file_hosts
+    ])
+    for i, file_host in enumerate(suspected):
+        offline_counter = 1  # <- result from my monitoring
+        for status in statuses[i * len(file_hosts):(i + 1) * len(file_hosts)]:
+            if status == HosterFileM2M.OFFLINE:
+                offline_counter += 1
+        logger.info(f'Monitoring: host is offline '
+                    f'| file: {file.hash} '
+                    f'| host: {file_host.host.address} '
+                    f'| # of hosts approved: {offline_counter}')
+        if offline_counter > settings.hosters_per_file / 2:
+            logger.info(f'Voting offline | file: {file.hash} | host: {file_host.host.address}')
+            async with monitoring_limits['rpc']:
+                await file.client_contract.vote_offline(
+                    address_of_offline=file_host.host.address,
+                    file_hash=file.hash
+                )
+                need_replace = await file.client_contract.need_replace(
+                    old_host_address=file_host.host.address,
+                    file_hash=file.hash
+                )
+            if need_replace:
+                logger.info(f'Host need replace | file: {file.hash} | host: {file_host.host.address}')
+                asyncio.ensure_future(
+                    upload_file_to_new_host(
+                        new_host=await Host.get_one_for_uploading_file(file),
+                        file=file,
+                        replacing=file_host
+                    )
+                )
+
+
 async def perform_monitoring_for_file(file: HosterFile):
     logger.info(f'Started monitoring for file | file: {file.hash}')
-    deposit = await file.check_deposit()
-    logger.info(f'Deposit: {deposit}')
-
-    file.refresh_from_contract()
+    async with monitoring_limits['rpc']:
+        deposit = await file.check_deposit()
+        logger.info(f'Deposit: {deposit}')
+        await file.refresh_hosts_from_contract()
+    await commit_async()  # file.file_hosts below queries the refreshed host list
 
     if not file.body_exists:
         logger.info(f'Deleting file (body does not exist) | file: {file.hash}')
-        file.delete()
+        await file.delete_async()
         return
 
-    if settings.address.lower() not in [
-        a.lower()
-        for a in file.client_contract.get_file_hosts(file.hash)
-    ]:
+    async with monitoring_limits['rpc']:
+        file_hosts = await file.client_contract.get_file_hosts(file.hash)
+        deposit = await file.check_deposit()
+    if settings.address.lower() not in [a.lower() for a in file_hosts]:
         logger.info(f'Deleting file (i am not in file host list from contract) | file: {file.hash}')
-        file.delete()
+        await file.delete_async()
         return
 
-    if not await file.check_deposit():
+    if not deposit:
         logger.info(f'No deposit for file | file: {file.hash}')
         file.update_status(HosterFile.WAIT_DEL)
         file.update_no_deposit_counter()
         if file.no_deposit_counter >= 3 * 7:  # 3x monitoring per day, 1 week
             logger.info(f'Deleting file (no deposit) | file: {file.hash}')
-            file.delete()
+            await file.delete_async()
         return
     else:
         logger.info(f'Deposit OK | file: {file.hash}')
         file.update_status(HosterFile.ACTIVE)
         file.reset_no_deposit_counter()
 
-    if file.client_contract.need_copy(file.hash):
+    async with monitoring_limits['rpc']:
+        need_copy = await file.client_contract.need_copy(file.hash)
+    if need_copy:
         logger.info(f'File need copy | file: {file.hash}')
-        host = Host.get_one_for_uploading_file(file)
+        host = await Host.get_one_for_uploading_file(file)
         if host:
             await upload_file_to_new_host(
                 new_host=host,
@@ -141,18 +351,35 @@ async def perform_monitoring_for_file(file: HosterFile):
     file_size = file.size
     from_ = random.randint(0, int(file_size / 2))
     to_ = random.randint(int(file_size / 2), file_size)
-    my_proof = await file.compute_chunk_hash(from_, to_)
+    leaves = None
+    if settings.storage_proof_mode == 'merkle':  # the index is built on first use, range proofs do not need it
+        async with monitoring_limits['disk']:
+            _, leaf_count = await file.get_merkle_root()
+        leaves = random.sample(range(leaf_count), min(settings.merkle_proof_leaves, leaf_count))
+    my_proof = None
+
+    async def get_my_proof():
+        nonlocal my_proof
+        if my_proof is None:
+            my_proof = asyncio.ensure_future(compute_my_proof())
+        return await my_proof
+
+    async def compute_my_proof():
+        async with monitoring_limits['disk']:
+            return await file.compute_chunk_hash(from_, to_)
+
     logger.info(f'Requesting file proofs | file: {file.hash}')
     if file.hosts:
         done, _ = await asyncio.wait(
             [
-                get_file_proof_from_hoster(file_host, from_, to_)
-                for file_host in file.file_hosts
+                check_file_host(file, file_host, leaves, from_, to_, get_my_proof)
+                for file_host in await file.get_file_hosts_async()
             ]
         )
+        suspected = []
         for task in done:
-            file_host, proof = task.result()
-            if proof == my_proof:
+            file_host, ok = task.result()
+            if ok:
                 file_host.update_last_ping()
                 file_host.reset_offline_counter()
                 file_host.update_status(HosterFileM2M.ACTIVE)
@@ -166,73 +393,29 @@ async def perform_monitoring_for_file(file: HosterFile):
                             f'| offline counter: {file_host.offline_counter}')
                 if file_host.offline_counter >= 6:
                     file_host.update_status(HosterFileM2M.OFFLINE)
-                    done, _ = await asyncio.wait(
-                        [
-                            get_file_status_from_hoster(
-                                hash_=file.hash,
-                                host_to_check_address=file_host.host.address,
-                                host=fh.host
-                            )
-                            for fh in file.file_hosts
-                        ]
-                    )
-                    offline_counter = 1  # <- result from my monitoring
-                    for task in done:
-                        status = task.result()
-                        if status == HosterFileM2M.OFFLINE:
-                            offline_counter += 1
-                    logger.info(f'Monitoring: host is offline '
-                                f'| file: {file.hash} '
-                                f'| host: {file_host.host.address} '
-                                f'| # of hosts approved: {offline_counter}')
-                    if offline_counter > settings.hosters_per_file / 2:
-                        logger.info(f'Voting offline | file: {file.hash} | host: {file_host.host.address}')
-                        await file.client_contract.vote_offline(
-                            address_of_offline=file_host.host.address,
-                            file_hash=file.hash
-                        )
-                        if file.client_contract.need_replace(
-                                old_host_address=file_host.host.address,
-                                file_hash=file.hash
-                        ):
-                            logger.info(f'Host need replace | file: {file.hash} | host: {file_host.host.address}')
-                            asyncio.ensure_future(
-                                upload_file_to_new_host(
-                                    new_host=Host.get_one_for_uploading_file(file),
-                                    file=file,
-                                    replacing=file_host
-                                )
-                            )
-
-
-async def make_task(file):
-    async def wrapper():
-        return await perform_monitoring_for_file(file)
-
-    return wrapper
-
-
-def get_hour_and_minute_by_number(my_monitoring_number) -> dict:
-    minutes_in_8_hrs = 60 * 8
-    n = random.randint(0, minutes_in_8_hrs / 10)
-    minutes_from_start = my_monitoring_number * (minutes_in_8_hrs / 10) + n
-    hour = (datetime.utcnow().hour + (minutes_from_start // 60)) % 24
-    minute = minutes_from_start % 60
-    return {
-        "hour": str(int(hour)),
-        "minute": str(int(minute))
-    }
+                    suspected.append(file_host)
+        if suspected:
+            await commit_async()  # other hosters request this status while voting
+            await vote_offline_hosts(file, suspected)
 
 
-async def update_schedule(_scheduler):
-    _scheduler.remove_all_jobs()
-    for file in HosterFile.objects.all():
-        _scheduler.add_job(
-            await make_task(file),
-            'cron',
-            **get_hour_and_minute_by_number(file.my_monitoring_number)
-        )
-    _scheduler.add_job(
+async def monitor_file(file_hash) -> bool:
+    """
+    :return: False if the file is not hosted anymore
+    """
+    # A monitoring pass for one file is one unit of work, committed once at the end.
+    async with unit_of_work():
+        try:
+            file = await HosterFile.find_async(file_hash, with_hosts=True)
+        except HosterFile.NotFound:
+            return False
+        await perform_monitoring_for_file(file)
+    return True
+
+
+def create_scheduler():
+    payments = AsyncIOScheduler()
+    payments.add_job(
         request_payment_for_all_files,
         'cron',
         week='*',
@@ -240,21 +423,17 @@ async def update_schedule(_scheduler):
         hour='0',
         minute='0'
     )
-    _scheduler.add_job(
-        asyncio.coroutine(_scheduler.update),
-        'cron',
-        hour='*/8',
+    payments.start()
+    _scheduler = MonitoringScheduler(
+        monitor_file,
+        interval=MONITORING_INTERVAL,
+        slots=settings.hosters_per_file,
+        workers=settings.monitoring_workers,
+        limits=monitoring_limits,
+        tick=settings.monitoring_tick if settings.peer_batching else 0
     )
-    with suppress(SchedulerAlreadyRunningError):
-        _scheduler.start()
-    with redirect_stdout(logger):
-        _scheduler.print_jobs()
-
-
-def create_scheduler():
-    _scheduler = AsyncIOScheduler()
-    _scheduler.update = lambda: asyncio.ensure_future(update_schedule(_scheduler))
-    _scheduler.update()
+    _scheduler.payments = payments
+    _scheduler.start(load=HosterFile.list_monitoring_numbers_async)
     return _scheduler
 
 
@@ -265,4 +444,5 @@ if __name__ == '__main__':
         loop.run_forever()
     except (KeyboardInterrupt, Exception):
         loop.stop()
-        scheduler.shutdown()
+        scheduler.stop()
+        scheduler.payments.shutdown()
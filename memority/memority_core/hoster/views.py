@@ -1,13 +1,16 @@
+import asyncio
 import logging
+import os
 
-from aiohttp import web
+from aiohttp import web, hdrs
 
 from models import HosterFile, HosterFileM2M
 from settings import settings
 from smart_contracts import token_contract
 from utils import InvalidSignature
 
-__all__ = ['final_metadata', 'proof', 'create_metadata', 'load_body', 'get_file', 'file_list', 'file_host_status']
+__all__ = ['final_metadata', 'proof', 'merkle_proof', 'batch_proof', 'create_metadata', 'load_body', 'get_file',
+           'file_list', 'file_host_status', 'batch_file_host_status']
 
 logger = logging.getLogger('memority')
 
@@ -26,18 +29,71 @@ async def get_file(request):
     file_hash = request.match_info.get('id')
     logger.info(f'File content | file: {file_hash}')
     try:
-        file = HosterFile.find(file_hash)
+        file = await HosterFile.find_async(file_hash)
         if not await file.check_deposit():
             return _error_response('No deposit for file', 402)
     except HosterFile.NotFound:
         logger.warning(f'File not found | file: {file_hash}')
         raise web.HTTPNotFound(reason='File not found!')
-    return web.Response(body=await file.get_body())
+    return await _send_box(request, file)
+
+
+def _etag_matches(etag, header):
+    return any(
+        value.strip() in ('*', etag, f'W/{etag}')
+        for value in header.split(',')
+    )
+
+
+async def _send_box(request, file: HosterFile):
+    """
+    Send box from disk with sendfile, without reading it into memory.
+    Supports single byte range requests (Range / If-Range) and conditional requests, ETag is the box hash.
+    """
+    path = os.path.join(settings.boxes_dir, file.hash)
+    try:
+        size = os.path.getsize(path)
+    except FileNotFoundError:
+        logger.warning(f'File body not found | file: {file.hash}')
+        raise web.HTTPNotFound(reason='File not found!')
+
+    etag = f'"{file.hash}"'
+    headers = {
+        hdrs.ETAG: etag,
+        hdrs.ACCEPT_RANGES: 'bytes',
+    }
+    if _etag_matches(etag, request.headers.get(hdrs.IF_NONE_MATCH, '')):
+        return web.Response(status=304, headers=headers)
+
+    status, start, count = 200, 0, size
+    if_range = request.headers.get(hdrs.IF_RANGE)
+    if hdrs.RANGE in request.headers and (if_range is None or if_range.strip() == etag):
+        try:
+            start, stop, _ = request.http_range.indices(size)
+        except ValueError:
+            start, stop = 0, 0
+        if start >= stop:
+            raise web.HTTPRequestRangeNotSatisfiable(headers={hdrs.CONTENT_RANGE: f'bytes */{size}'})
+        status, count = 206, stop - start
+        headers[hdrs.CONTENT_RANGE] = f'bytes {start}-{stop - 1}/{size}'
+
+    response = web.StreamResponse(status=status, headers=headers)
+    response.content_type = 'application/octet-stream'
+    response.content_length = count
+    await response.prepare(request)
+    if count and request.method != hdrs.METH_HEAD:
+        if request.transport is None:
+            raise ConnectionResetError('Connection lost')
+        with open(path, 'rb') as f:
+            # Zero-copy where the event loop supports it, chunked copy otherwise.
+            await asyncio.get_event_loop().sendfile(request.transport, f, start, count)
+    await response.write_eof()
+    return response
 
 
 async def file_list(request):
     logger.info('File list')
-    files = HosterFile.list_hashes()
+    files = await HosterFile.list_hashes_async()
     return web.json_response({
         "status": "success",
         "data": {
@@ -57,7 +113,7 @@ async def create_metadata(request):
             Fields 'file_hash', 'owner_key', 'signature', 'client_contract_address' are required.'''
         )
 
-    if data.get('size') > (settings.disk_space_for_hosting * (1024 ** 3) - HosterFile.get_total_size()):
+    if data.get('size') > (settings.disk_space_for_hosting * (1024 ** 3) - await HosterFile.get_total_size_async()):
         return _error_response('Not enough space')
 
     if not await token_contract.get_deposit(
@@ -73,8 +129,9 @@ async def create_metadata(request):
 
     try:
         instance = await HosterFile.create_metadata(**data)
-        if 'hosts' in data:
-            request.app['scheduler'].update()
+        if data.get('hosts'):
+            # a file without hosts gets its body and host list later, it is scheduled in final_metadata
+            request.app['scheduler'].add(instance.hash, instance.my_monitoring_number)
     except InvalidSignature:
         logger.warning(f'Invalid signature | file: {data["file_hash"]} | signature: {data["signature"]}')
         raise web.HTTPBadRequest(reason='Invalid signature!')
@@ -125,7 +182,7 @@ async def proof(request):
     if not (from_.isdigit() and to_.isdigit()):
         return _error_response("invalid GET parameters")
     try:
-        file = HosterFile.find(file_hash)
+        file = await HosterFile.find_async(file_hash)
         chunk_hash = await file.compute_chunk_hash(int(from_), int(to_))
     except HosterFile.NotFound:
         msg = f'File not found | file: {file_hash}'
@@ -141,12 +198,90 @@ async def proof(request):
     )
 
 
+async def merkle_proof(request):
+    file_hash = request.match_info.get('id')
+    leaves = request.query.get('leaves', '').split(',')
+    logger.info(f'File storage Merkle proof | file: {file_hash} | leaves: {leaves}')
+    if not all(leaf.isdigit() for leaf in leaves) or len(leaves) > settings.merkle_proof_max_leaves:
+        return _error_response("invalid GET parameters")
+    try:
+        file = await HosterFile.find_async(file_hash)
+        proofs = await file.get_merkle_proofs([int(leaf) for leaf in leaves])
+    except HosterFile.NotFound:
+        msg = f'File not found | file: {file_hash}'
+        logger.warning(msg)
+        return _error_response(msg, code=404)
+    except ValueError as err:
+        return _error_response(str(err))
+    return web.json_response(
+        {
+            "status": "success",
+            "data": {
+                "proofs": proofs
+            }
+        }
+    )
+
+
+def _is_offset(value):
+    return isinstance(value, int) and not isinstance(value, bool) and value >= 0
+
+
+async def _answer_challenge(files: dict, challenge) -> dict:
+    if not isinstance(challenge, dict):
+        return {"error": "invalid challenge"}
+    file = files.get(challenge.get('hash'))
+    try:
+        if file is None:
+            raise HosterFile.NotFound
+        if 'leaves' in challenge:
+            leaves = challenge['leaves']
+            if not (isinstance(leaves, list) and all(_is_offset(leaf) for leaf in leaves)) \
+                    or len(leaves) > settings.merkle_proof_max_leaves:
+                return {"error": "invalid challenge"}
+            return {"proofs": await file.get_merkle_proofs(leaves)}
+        from_, to_ = challenge.get('from'), challenge.get('to')
+        if not (_is_offset(from_) and _is_offset(to_)):
+            return {"error": "invalid challenge"}
+        return {"hash": await file.compute_chunk_hash(from_, to_)}
+    except HosterFile.NotFound:
+        return {"error": "not found"}
+    except ValueError as err:
+        return {"error": str(err)}
+
+
+async def batch_proof(request):
+    """
+    Storage proofs of many files in one request, for hosters monitoring many shared files.
+    Challenges: [{"hash", "from", "to"}] for range hashes or [{"hash", "leaves"}] for Merkle proofs.
+    Results are in the order of challenges: {"hash"}, {"proofs"} or {"error"}.
+    """
+    data = await request.json()
+    challenges = data.get('challenges') if isinstance(data, dict) else None
+    if not isinstance(challenges, list) or len(challenges) > settings.peer_batch_max_size:
+        return _error_response("invalid challenges")
+    logger.info(f'File storage proofs | challenges: {len(challenges)}')
+    files = await HosterFile.find_many_async({
+        challenge.get('hash') for challenge in challenges
+        if isinstance(challenge, dict) and isinstance(challenge.get('hash'), str)
+    })
+    results = await asyncio.gather(*[_answer_challenge(files, challenge) for challenge in challenges])
+    return web.json_response(
+        {
+            "status": "success",
+            "data": {
+                "results": results
+            }
+        }
+    )
+
+
 async def file_host_status(request):
     file_hash = request.match_info.get('id')
     host_address = request.match_info.get('host')
     logger.info(f'File host status | file: {file_hash} | host: {host_address}')
     try:
-        status = HosterFileM2M.get_status(file_hash, host_address)
+        status = await HosterFileM2M.get_status_async(file_hash, host_address)
     except HosterFileM2M.NotFound:
         msg = f'Hoster file not found | file: {file_hash} | host: {host_address}'
         logger.warning(msg)
@@ -161,21 +296,50 @@ async def file_host_status(request):
     )
 
 
+async def batch_file_host_status(request):
+    """
+    Statuses of many (file, host) pairs in one request, for offline voting on hosters sharing many files.
+    Pairs: [{"hash", "host"}], results are in the order of pairs: {"status"} or {"error"}.
+    """
+    data = await request.json()
+    pairs = data.get('pairs') if isinstance(data, dict) else None
+    if not isinstance(pairs, list) or len(pairs) > settings.peer_batch_max_size:
+        return _error_response("invalid pairs")
+    logger.info(f'File host statuses | pairs: {len(pairs)}')
+    keys = [
+        (pair.get('hash'), pair.get('host'))
+        if isinstance(pair, dict) and isinstance(pair.get('hash'), str) and isinstance(pair.get('host'), str)
+        else None
+        for pair in pairs
+    ]
+    statuses = await HosterFileM2M.get_statuses_async([key for key in keys if key])
+    return web.json_response(
+        {
+            "status": "success",
+            "data": {
+                "results": [
+                    {"status": statuses[key]} if key in statuses else {"error": "not found" if key else "invalid pair"}
+                    for key in keys
+                ]
+            }
+        }
+    )
+
+
 async def final_metadata(request):
     # ToDo: merge with create_metadata
     file_hash = request.match_info.get('id', None)
     logger.info(f'Uploading final metadata | file: {file_hash}')
     try:
-        instance = HosterFile.find(file_hash)
+        instance = await HosterFile.find_async(file_hash)
     except HosterFile.NotFound:
         logger.warning(f'File not found | file: {file_hash}')
         raise web.HTTPNotFound(reason='File not found!')
     data = await request.json()
     hosts = data.get('hosts')
-    instance.add_hosts(hosts)
-    logger.info('Updating schedule...')
-    request.app['scheduler'].update()
-    logger.info('Schedule updated')
+    await instance.add_hosts(hosts)
+    request.app['scheduler'].add(instance.hash, instance.my_monitoring_number)
+    logger.info(f'Scheduled monitoring | file: {instance.hash}')
     return web.json_response({
         "status": "success",
         "data": {
@@ -12,6 +12,7 @@ from shutil import copyfile
 from threading import Thread
 
 import contextlib
+import multiprocessing
 
 import renter
 import smart_contracts
@@ -21,8 +22,8 @@ from logger import setup_logging
 from renter.server import create_renter_app
 from settings import settings
 from smart_contracts.smart_contract_api import w3, import_private_key_to_eth, token_contract, client_contract, \
-    memo_db_contract
-from utils import ask_for_password
+    memo_db_contract, get_client_contract, transaction_manager
+from utils import ask_for_password, shutdown_crypto_executor
 
 
 def process_line(line):
@@ -152,6 +153,8 @@ class MemorityCore:
                 token_contract.reload()
                 client_contract.reload()
                 memo_db_contract.reload()
+                get_client_contract.cache_clear()
+                transaction_manager.reset()
                 break
         self.q = Queue()
         self.t = Thread(target=enqueue_output, args=(self.p.stdout, self.q), daemon=True)
@@ -195,6 +198,7 @@ class MemorityCore:
             self.event_loop.run_until_complete(self.renter_app.shutdown())
             self.event_loop.run_until_complete(self.renter_app_handler.shutdown(60.0))
             self.event_loop.run_until_complete(self.renter_app.cleanup())
+        shutdown_crypto_executor()
         if self.p:
             self.p.terminate()
             self.p.wait()
@@ -207,6 +211,7 @@ ON_POSIX = 'posix' in sys.builtin_module_names
 platform_name = platform.system()
 
 if __name__ == '__main__':
+    multiprocessing.freeze_support()  # crypto_executor: process in frozen builds
     loop = asyncio.get_event_loop()
 
     password, run_geth = None, False
@@ -1,5 +1,6 @@
 from .base import Wallet, Stats, HosterFile, Host, RenterFile, RenterFileM2M, HosterFileM2M
-from .db import engine, create_tables
+from .db import engine, create_tables, unit_of_work, commit, commit_async, run_db
+from .migrations import migrate
 
 if not all(
         [
@@ -10,3 +11,4 @@ if not all(
             for cls in [RenterFile, Host, HosterFile, Wallet, Stats, RenterFileM2M, HosterFileM2M]
         ]):
     create_tables()
+migrate(engine)
@@ -1,19 +1,28 @@
+import asyncio
+import base64
 import contextlib
+import logging
 import os
+import tempfile
 from datetime import datetime, timedelta
 from io import BytesIO
 
 import aiofiles
 import tzlocal
-from sqlalchemy import Column, Integer, String, TIMESTAMP, ForeignKey, func, Boolean
+from sqlalchemy import Column, Integer, String, TIMESTAMP, ForeignKey, func, Boolean, inspect, Index
 from sqlalchemy.exc import IntegrityError
-from sqlalchemy.orm import relationship, backref
+from sqlalchemy.orm import relationship, backref, joinedload, selectinload
 from sqlalchemy.orm.exc import NoResultFound
 
 from settings import settings
-from smart_contracts import token_contract, client_contract, memo_db_contract, ClientContract
-from utils import compute_hash, InvalidSignature, encrypt, decrypt, sign, DecryptionError
-from .db import Base, session
+from smart_contracts import token_contract, client_contract, memo_db_contract, get_client_contract
+from utils import compute_hash_async, InvalidSignature, encrypt, decrypt, DecryptionError, \
+    StreamDecryptor, hash_stream, signature_stream, CHUNKED_MAGIC, \
+    encrypt_async, decrypt_async, sign_async, sign_digest_async, encrypt_chunk_async, compute_file_hash_async, \
+    run_crypto, build_merkle_index, read_merkle_root, merkle_proof, verify_merkle_proof
+from .db import Base, engine, session, commit, in_unit_of_work, run_db, commit_async, unit_of_work
+
+logger = logging.getLogger('memority')
 
 
 class Manager:
@@ -32,6 +41,12 @@ class Manager:
         except NoResultFound:
             raise self._managed_class.NotFound
 
+    async def all_async(self):
+        return await run_db(self.all)
+
+    async def get_async(self, **kwargs):
+        return await run_db(self.get, **kwargs)
+
 
 class ManagedMixin:
 
@@ -42,16 +57,30 @@ class ManagedMixin:
         cls.objects = Manager(cls)
 
     def save(self):
-        try:
-            session.add(self)
-            session.commit()
-        except IntegrityError:
-            session.rollback()
-            raise
+        """
+        Inside a unit of work the change is committed with the unit, otherwise immediately.
+        """
+        session.add(self)
+        if not in_unit_of_work():
+            commit()
 
     def delete(self):
-        session.delete(self)
-        session.commit()
+        if inspect(self).pending:
+            session.expunge(self)
+        else:
+            session.delete(self)
+        if not in_unit_of_work():
+            commit()
+
+    async def delete_async(self):
+        await run_db(self.delete)
+
+    @classmethod
+    def find_pending(cls, predicate):
+        """
+        Instance added in the current unit of work and not committed yet, queries do not see those.
+        """
+        return next((obj for obj in session.new if isinstance(obj, cls) and predicate(obj)), None)
 
 
 class Host(Base, ManagedMixin):
@@ -65,6 +94,12 @@ class Host(Base, ManagedMixin):
     hosted_files = relationship('HosterFile', secondary='hoster_files_m2m')
     renter_files = relationship('RenterFile', secondary='renter_files_m2m')
 
+    _refresh_task = None
+
+    __table_args__ = (
+        Index('ix_hosts_address_lower', func.lower(address)),  # see _find_many
+    )
+
     def __init__(self, ip, address, rating=0) -> None:
         self.address = address
         self.ip = ip
@@ -77,61 +112,141 @@ class Host(Base, ManagedMixin):
         return f'Hoster | address: {self.address} | ip: {self.ip}'
 
     @classmethod
-    def get_or_create(cls, *, ip=None, address):
-        try:
-            instance = session.query(cls) \
-                .filter(func.lower(cls.address) == func.lower(address)) \
-                .one()
-        except NoResultFound:
-            if not ip:
-                ip = memo_db_contract.get_host_ip(address)
-            instance = cls(ip=ip, address=address)
-            instance.save()
-        return instance
+    def _find_many(cls, addresses) -> dict:
+        """
+        :return: {lowercased address: host} of known hosts, including the ones pending in the current unit of work
+        """
+        lowered = {a.lower() for a in addresses}
+        by_address = {
+            h.address.lower(): h
+            for h in session.new
+            if isinstance(h, cls) and h.address.lower() in lowered
+        }
+        missing = lowered - by_address.keys()
+        if missing:
+            for host in session.query(cls).filter(func.lower(cls.address).in_(missing)):
+                by_address[host.address.lower()] = host
+        return by_address
 
     @classmethod
-    def update_or_create(cls, ip, address):
-        try:
-            try:
-                query = session.query(cls).filter(func.lower(cls.address) == func.lower(address))
-                instance = query.one()
-            except NoResultFound:
-                raise cls.NotFound
-            instance.ip = ip
-        except cls.NotFound:
-            instance = cls(ip=ip, address=address)
-        instance.save()
+    async def get_or_create_many(cls, addresses: list, ips: dict = None) -> list:
+        """
+        Get or create hosts in bulk: one query for all known hosts, one batched contract request for new ones.
+        :param ips: {lowercased address: ip} known in advance, the rest is read from the contract
+        :return: hosts in the order of addresses
+        """
+        by_address = await run_db(cls._find_many, addresses)
+        unknown = list({a.lower(): a for a in addresses if a.lower() not in by_address}.values())
+        if unknown:
+            ips = dict(ips or {})
+            to_fetch = [a for a in unknown if a.lower() not in ips]
+            if to_fetch:
+                ips.update(zip((a.lower() for a in to_fetch), await memo_db_contract.get_host_ips(to_fetch)))
+            by_address.update(await run_db(cls._create_many, unknown, ips))
+        return [by_address[address.lower()] for address in addresses]
 
     @classmethod
-    def refresh_from_contract(cls):
-        hosts = memo_db_contract.get_hosts()
-        for host_address in hosts:
-            with contextlib.suppress(IntegrityError):
-                cls.update_or_create(
-                    ip=memo_db_contract.get_host_ip(host_address),
-                    address=host_address
+    def _create_many(cls, addresses, ips: dict) -> dict:
+        by_address = cls._find_many(addresses)  # could be created while the contract was called
+        missing = [a for a in addresses if a.lower() not in by_address]
+        if missing:
+            # Inserted and committed right away, outside of the unit of work: overlapping units
+            # creating the same host would otherwise both add it and the later commit would fail.
+            with engine.begin() as connection:
+                connection.execute(
+                    cls.__table__.insert().prefix_with('OR IGNORE'),
+                    [{'address': a, 'ip': ips[a.lower()], 'rating': 0} for a in missing]
                 )
+            by_address.update(cls._find_many(missing))
+        for address in missing:
+            if address.lower() not in by_address:  # ip is taken by another address
+                host = cls(ip=ips[address.lower()], address=address)
+                host.save()
+                by_address[address.lower()] = host
+        return by_address
+
+    @classmethod
+    async def refresh_from_contract(cls):
+        """
+        Bulk host registry sync: host IPs are fetched concurrently (at most `host_sync_concurrency`
+        contract calls at once), diffed against all known hosts and applied in one transaction.
+        """
+        addresses = await memo_db_contract.get_hosts()
+        semaphore = asyncio.Semaphore(settings.host_sync_concurrency)
+
+        async def get_ip(address):
+            async with semaphore:
+                return await memo_db_contract.get_host_ip(address)
+
+        ips = await asyncio.gather(*[get_ip(address) for address in addresses], return_exceptions=True)
+        async with unit_of_work():
+            await run_db(cls._apply_host_ips, {
+                address: ip
+                for address, ip in zip(addresses, ips)
+                if ip and not isinstance(ip, Exception)
+            })
+            await run_db(Stats.update_host_list_sync_time)
 
     @classmethod
-    def get_n(cls, n=10):
-        time = Stats.get_host_list_sync_time()
+    def _apply_host_ips(cls, ips: dict):
+        hosts = {h.address.lower(): h for h in session.query(cls)}
+        taken = {h.ip: address for address, h in hosts.items()}
+        for address, ip in ips.items():
+            host = hosts.get(address.lower())
+            if host and host.ip == ip:
+                continue
+            if taken.get(ip, address.lower()) != address.lower():
+                logger.warning(f'Host ip is taken by another host | address: {address} | ip: {ip}')
+                continue
+            if host:
+                host.ip = ip
+            else:
+                session.add(cls(ip=ip, address=address))
+            taken[ip] = address.lower()
+
+    @classmethod
+    def refresh_in_background(cls):
+        """
+        Start refresh_from_contract unless it is already running.
+        """
+        if cls._refresh_task is None or cls._refresh_task.done():
+            cls._refresh_task = asyncio.ensure_future(cls.refresh_from_contract())
+        return cls._refresh_task
+
+    @classmethod
+    async def get_n(cls, n=10):
+        """
+        Random hosts for uploading. An obsolete host list is refreshed in the background,
+        the caller waits for the refresh only if there are no hosts at all.
+        """
+        def query():
+            time = Stats.get_host_list_sync_time()
+            return time, session.query(cls) \
+                .filter(cls.address != settings.address) \
+                .order_by(func.random()) \
+                .limit(n) \
+                .all()
+
+        time, hosts = await run_db(query)
         if not time or time < datetime.utcnow() - timedelta(days=settings.host_list_obsolescence_days):
-            cls.refresh_from_contract()
-            Stats.update_host_list_sync_time()
-        return session.query(cls).filter(cls.address != settings.address).order_by(func.random()).limit(n)
+            refresh = cls.refresh_in_background()
+            if not hosts:
+                await refresh
+                _, hosts = await run_db(query)
+        return hosts
 
     @classmethod
-    def get_one_for_uploading_file(cls, file):
-        res = session.query(Host) \
-            .filter(~cls.address.in_([h.address for h in file.hosts])) \
-            .order_by(func.random()) \
-            .first()
-        if not res:
-            cls.refresh_from_contract()
-            res = session.query(Host) \
+    async def get_one_for_uploading_file(cls, file):
+        def query():
+            return session.query(Host) \
                 .filter(~cls.address.in_([h.address for h in file.hosts])) \
                 .order_by(func.random()) \
                 .first()
+
+        res = await run_db(query)
+        if not res:
+            await cls.refresh_in_background()
+            res = await run_db(query)
         return res
 
 
@@ -173,7 +288,7 @@ class HosterFile(Base, ManagedMixin):
 
     @property
     def client_contract(self):
-        return ClientContract(address=self.client_contract_address)
+        return get_client_contract(self.client_contract_address)
 
     @classmethod
     async def create_metadata(cls, file_hash, owner_key, signature, client_contract_address, size,
@@ -196,29 +311,32 @@ class HosterFile(Base, ManagedMixin):
                     hosts[index] = settings.address  # for properly setting monitoring num
                 else:
                     hosts.append(settings.address)
-                instance.add_hosts(hosts)
+                await instance.add_hosts(hosts)
                 instance.send_data_to_contract_after_uploading_body = True
                 if replacing:
                     instance.replacing_host_address = replacing
                 instance.save()
+            await commit_async()
         except IntegrityError:
-            session.rollback()
             raise cls.AlreadyExists
         return instance
 
     @classmethod
     async def load_body(cls, data_reader, file_hash):
-        instance = cls.find(file_hash)
+        instance = await cls.find_async(file_hash)
         # ToDo: verify signature
 
         path = os.path.join(settings.boxes_dir, file_hash)
         async with aiofiles.open(path, 'wb') as f:
             async for chunk, _ in data_reader:
                 await f.write(chunk)
+        if settings.storage_proof_mode == 'merkle':  # range proofs do not need the index
+            await instance.build_merkle_index()
 
         instance.path = path
 
         instance.save()
+        await commit_async()  # the body is stored even if the contract call below fails
         if instance.send_data_to_contract_after_uploading_body:
             if instance.replacing_host_address:
                 await instance.client_contract.replace_host(
@@ -234,19 +352,12 @@ class HosterFile(Base, ManagedMixin):
     def delete(self):
         with contextlib.suppress(FileNotFoundError):
             os.remove(os.path.join(settings.boxes_dir, self.hash))
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.merkle_index_path)
         for hf in self.file_hosts:
             hf.delete()
         super().delete()
 
-    async def get_body(self):
-        path = os.path.join(settings.boxes_dir, self.hash)
-        try:
-            async with aiofiles.open(path, 'rb') as f:
-                body = await f.read()
-            return body
-        except FileNotFoundError:
-            raise self.NotFound
-
     async def get_filelike(self):
         path = os.path.join(settings.boxes_dir, self.hash)
         try:
@@ -263,50 +374,145 @@ class HosterFile(Base, ManagedMixin):
         return os.path.isfile(os.path.join(settings.boxes_dir, self.hash))
 
     async def compute_chunk_hash(self, from_: int, to_: int) -> str:
-        body = await self.get_body()
-        chunk = body[from_:to_]
-        return compute_hash(chunk)
+        path = os.path.join(settings.boxes_dir, self.hash)
+        try:
+            return await compute_file_hash_async(path, from_, to_)
+        except FileNotFoundError:
+            raise self.NotFound
+
+    @property
+    def merkle_index_path(self):
+        return os.path.join(settings.boxes_dir, f'{self.hash}.merkle')
+
+    async def build_merkle_index(self):
+        path = os.path.join(settings.boxes_dir, self.hash)
+        try:
+            return await run_crypto(build_merkle_index, path, self.merkle_index_path)
+        except FileNotFoundError:
+            raise self.NotFound
+
+    async def get_merkle_root(self) -> (bytes, int):
+        """
+        :return: root, leaf count; the index is built on first use for boxes uploaded without it
+        """
+        if not os.path.isfile(self.merkle_index_path):
+            await self.build_merkle_index()
+        return await run_crypto(read_merkle_root, self.merkle_index_path)
+
+    async def get_merkle_proofs(self, leaves: list) -> list:
+        """
+        :raise ValueError: leaf out of range
+        """
+        if not os.path.isfile(self.merkle_index_path):
+            await self.build_merkle_index()
+        path = os.path.join(settings.boxes_dir, self.hash)
+        proofs = []
+        for leaf in leaves:
+            block, auth_path = await run_crypto(merkle_proof, path, self.merkle_index_path, leaf)
+            proofs.append({
+                "leaf": leaf,
+                "block": base64.b64encode(block).decode('ascii'),
+                "path": [node.hex() for node in auth_path]
+            })
+        return proofs
+
+    async def verify_merkle_proofs(self, leaves: list, proofs: list) -> bool:
+        root, leaf_count = await self.get_merkle_root()
+        try:
+            proofs = {p['leaf']: p for p in proofs}
+            return all(
+                verify_merkle_proof(
+                    root,
+                    leaf_count,
+                    leaf,
+                    base64.b64decode(proofs[leaf]['block']),
+                    [bytes.fromhex(node) for node in proofs[leaf]['path']]
+                )
+                for leaf in leaves
+            )
+        except (KeyError, TypeError, ValueError):
+            return False
 
     @classmethod
-    def find(cls, box_hash):
+    def find(cls, box_hash, with_hosts=False):
+        """
+        :param with_hosts: load the host list in the same round trip, for the monitoring
+        """
         try:
-            instance = cls.objects.get(hash=box_hash)
-            return instance
+            query = session.query(cls).filter_by(hash=box_hash)
+            if with_hosts:
+                query = query.options(selectinload(cls.hosts))
+            return query.one()
         except NoResultFound:
             raise cls.NotFound
 
+    @classmethod
+    async def find_async(cls, box_hash, with_hosts=False):
+        return await run_db(cls.find, box_hash, with_hosts)
+
+    @classmethod
+    def find_many(cls, box_hashes) -> dict:
+        """
+        :return: {hash: file} of the hashes that are hosted
+        """
+        return {file.hash: file for file in session.query(cls).filter(cls.hash.in_(list(box_hashes)))}
+
+    @classmethod
+    async def find_many_async(cls, box_hashes) -> dict:
+        return await run_db(cls.find_many, box_hashes)
+
     @classmethod
     def list_hashes(cls):
         results = session.query(cls.hash).all()
         return results
 
-    def add_hosts(self, hosts: list):
+    @classmethod
+    async def list_hashes_async(cls):
+        return await run_db(cls.list_hashes)
+
+    @classmethod
+    def list_monitoring_numbers(cls):
+        return session.query(cls.hash, cls.my_monitoring_number).all()
+
+    @classmethod
+    async def list_monitoring_numbers_async(cls):
+        return await run_db(cls.list_monitoring_numbers)
+
+    async def add_hosts(self, hosts: list):
         # client_contract file hosts - sequential, so it is ok.
         with contextlib.suppress(ValueError):
             my_num = [h.lower() for h in hosts].index(settings.address.lower())
             self.my_monitoring_number = my_num
-        for host_address in hosts:
-            host = Host.get_or_create(address=host_address)
-            if host not in self.hosts:
+        await run_db(self._add_hosts, await Host.get_or_create_many(hosts))
+
+    def _add_hosts(self, hosts: list):
+        known = set(self.hosts)
+        for host in hosts:
+            if host not in known:
                 self.hosts.append(host)
+                known.add(host)
         self.save()
 
     @property
     def file_hosts(self):
-        return session.query(HosterFileM2M).join(HosterFile).filter(HosterFile.id == self.id).all()
-
-    @classmethod
-    def refresh_from_contract(cls):
-        for file in cls.objects.all():
-            file_hosts_db = file.file_hosts
-            file_hosts_contract = file.client_contract.get_file_hosts(file.hash)
-            # region Delete from db file hosts, removed from contract.
-            for hfm2m in [h for h in file_hosts_db if h.host.address not in file_hosts_contract]:
-                hfm2m.delete()
-            # endregion
-            file.add_hosts(
-                file_hosts_contract
-            )
+        return session.query(HosterFileM2M) \
+            .filter(HosterFileM2M.file_id == self.id) \
+            .options(joinedload(HosterFileM2M.host), joinedload(HosterFileM2M.file)) \
+            .all()
+
+    async def get_file_hosts_async(self):
+        return await run_db(lambda: self.file_hosts)
+
+    async def refresh_hosts_from_contract(self):
+        file_hosts_contract = await self.client_contract.get_file_hosts(self.hash)
+        # region Delete from db file hosts, removed from contract.
+        contract_addresses = {address.lower() for address in file_hosts_contract}
+        for host in [h for h in self.hosts if h.address.lower() not in contract_addresses]:
+            self.hosts.remove(host)
+        # endregion
+        await self.add_hosts(
+            file_hosts_contract
+        )
 
     def update_no_deposit_counter(self):
         self.no_deposit_counter += 1
@@ -330,6 +536,10 @@ class HosterFile(Base, ManagedMixin):
     def get_total_size(cls):
         return session.query(func.sum(cls.size)).one()[0] or 0
 
+    @classmethod
+    async def get_total_size_async(cls):
+        return await run_db(cls.get_total_size)
+
 
 class RenterFile(Base, ManagedMixin):
     __tablename__ = 'renter_files'
@@ -352,99 +562,181 @@ class RenterFile(Base, ManagedMixin):
     def __str__(self) -> str:
         return self.name
 
-    def __init__(self, *, name, body=None, hash_=None, encrypted=False, status=None) -> None:
+    def __init__(self, *, name, body=None, hash_=None, encrypted=False, status=None, source_path=None) -> None:
         self.name = name
         self.body = body
         self.encrypted = encrypted
         self.hash = hash_
         self.status = status or self.PREPARING
+        self.source_path = source_path
+        self.spool_path = None
+        self.spool_size = None
+
+    @property
+    def streaming(self):
+        """
+        Streaming mode: the body is never held in memory,
+        it is encrypted chunk by chunk from source_path into a spool file.
+        """
+        return bool(getattr(self, 'source_path', None))
 
     def get_filelike(self):
+        if self.streaming:
+            return self._iter_spool()
         return BytesIO(self.body)
 
+    async def _iter_spool(self):
+        async with aiofiles.open(self.spool_path, 'rb') as f:
+            chunk = await f.read(64 * 1024)
+            while chunk:
+                yield chunk
+                chunk = await f.read(64 * 1024)
+
     @classmethod
     async def open(cls, path):
+        if os.path.getsize(path) > settings.streaming_upload_threshold:
+            return cls(
+                name=os.path.basename(path),
+                source_path=path
+            )
         async with aiofiles.open(path, 'rb') as f:
             body = await f.read()
         return cls(
             name=os.path.basename(path),
             body=body,
-            hash_=compute_hash(body + settings.address.encode('utf-8'))
+            hash_=await compute_hash_async(body + settings.address.encode('utf-8'))
         )
 
     @classmethod
     async def list(cls):
-        results = session.query(cls).all()
+        results = await cls.objects.all_async()
         return [await r.to_json() for r in results]
 
     @classmethod
-    def find(cls, hash_):
+    async def find_async(cls, hash_):
+        """
+        :raise NotFound: the file is neither in the db nor in the Client contract
+        """
         try:
-            instance = cls.objects.get(hash=hash_)
-            return instance
-        except NoResultFound:
-            cls.refresh_from_contract()
-            try:
-                instance = cls.objects.get(hash=hash_)
-                return instance
-            except NoResultFound:
-                raise cls.NotFound
-
-    @classmethod
-    def update_or_create(cls, name, hash_, hosts, status=None):
-        try:
-            instance = cls.objects.get(hash=hash_)
-            instance.name = name
+            return await cls.objects.get_async(hash=hash_)
         except cls.NotFound:
-            instance = cls(name=name, hash_=hash_, encrypted=True, status=status)
-
-        for host_address in hosts:
-            host = Host.get_or_create(address=host_address)
-            instance.hosters.append(host)
-
-        instance.save()
-
-    def load_body(self, body: bytes):
-        self.body = body
-        self.encrypted = True
-
-    async def save_to_fs(self, destination=None):
-        assert not self.encrypted
-        path = os.path.join(destination, self.name) if destination else self.name
+            await cls.refresh_from_contract()
+            return await cls.objects.get_async(hash=hash_)
+
+    def destination_path(self, destination=None):
+        name = self.decrypted_name
+        return os.path.join(destination, name) if destination else name
+
+    async def save_stream_to_fs(self, chunks, destination=None):
+        """
+        Decrypt ciphertext chunks straight to disk.
+        Data goes to a temp file next to the destination, which is renamed into place
+        only after the whole ciphertext is authenticated.
+        :param chunks: async iterable of ciphertext pieces
+        :raise FileExistsError: destination file exists
+        :raise DecryptionError: ciphertext is corrupted or truncated
+        """
+        path = self.destination_path(destination)
         if os.path.isfile(path):
             raise FileExistsError
-        async with aiofiles.open(path, 'wb') as f:
-            await f.write(self.body)
+        fd, tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(path)),
+            prefix=f'.{os.path.basename(path)}.',
+            suffix='.part'
+        )
+        os.close(fd)
+        try:
+            decryptor = StreamDecryptor()
+            async with aiofiles.open(tmp_path, 'wb') as f:
+                async for chunk in chunks:
+                    await f.write(await decryptor.update_async(chunk))
+                await f.write(await decryptor.finalize_async())
+            if os.path.isfile(path):
+                raise FileExistsError
+            os.replace(tmp_path, path)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp_path)
+            raise
 
     @property
     def file_hosts(self):
-        return session.query(RenterFileM2M).join(RenterFile).filter(RenterFile.id == self.id).all()
+        return session.query(RenterFileM2M) \
+            .filter(RenterFileM2M.file_id == self.id) \
+            .options(joinedload(RenterFileM2M.host), joinedload(RenterFileM2M.file)) \
+            .all()
 
     def delete(self):
         for h in self.file_hosts:
             h.delete()
         super().delete()
 
-    def encrypt(self):
-        self.body = encrypt(self.body)
+    async def encrypt(self):
+        self.body = await encrypt_async(self.body)
         self.name = encrypt(self.name.encode('utf-8')).decode('utf-8')
         self.encrypted = True
 
-    def decrypt(self):
-        self.body = decrypt(self.body)
-        with contextlib.suppress(DecryptionError):
-            self.name = decrypt(
-                self.name.encode('utf-8') if isinstance(self.name, bytes) else self.name.encode('utf-8')
-            ).decode('utf-8')
-        self.encrypted = False
-
-    def sign(self):
-        self.signature = sign(self.body)
+    @property
+    def decrypted_name(self):
+        """
+        Plaintext name, the name column keeps the encrypted one.
+        """
+        try:
+            return decrypt(self.name.encode('utf-8')).decode('utf-8')
+        except DecryptionError:
+            return self.name
+
+    async def sign(self):
+        self.signature = await sign_async(self.body)
+
+    async def encrypt_to_spool(self):
+        """
+        Streaming counterpart of encrypt + sign:
+        source file -> chunk-framed ciphertext in a spool file, hash and signature computed on the fly.
+        """
+        chunk_size = settings.upload_chunk_size
+        content_hash = hash_stream()
+        signature_hash = signature_stream()
+        fd, self.spool_path = tempfile.mkstemp(dir=settings.tmp_dir, suffix='.upload')
+        os.close(fd)
+        async with aiofiles.open(self.source_path, 'rb') as src, aiofiles.open(self.spool_path, 'wb') as dst:
+            await dst.write(CHUNKED_MAGIC)
+            signature_hash.update(CHUNKED_MAGIC)
+            size = len(CHUNKED_MAGIC)
+            index = 0
+            chunk = await src.read(chunk_size)
+            while True:
+                next_chunk = await src.read(chunk_size) if chunk else b''
+                content_hash.update(chunk)
+                frame = await encrypt_chunk_async(chunk, index, last=not next_chunk)
+                await dst.write(frame)
+                signature_hash.update(frame)
+                size += len(frame)
+                if not next_chunk:
+                    break
+                chunk = next_chunk
+                index += 1
+        content_hash.update(settings.address.encode('utf-8'))
+        self.hash = content_hash.hexdigest()
+        self.signature = await sign_digest_async(signature_hash.digest())
+        self.spool_size = size
+        self.name = encrypt(self.name.encode('utf-8')).decode('utf-8')
+        self.encrypted = True
 
-    def prepare_to_uploading(self):
-        self.encrypt()
-        self.sign()
+    def discard_spool(self):
+        if getattr(self, 'spool_path', None):
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self.spool_path)
+            self.spool_path = None
+
+    async def prepare_to_uploading(self):
+        if self.streaming:
+            await self.encrypt_to_spool()
+        else:
+            await self.encrypt()
+            await self.sign()
         self.save()
+        await commit_async()  # IntegrityError for already uploaded files is handled by the caller
 
     def update_status(self, status):
         self.status = status
@@ -452,6 +744,8 @@ class RenterFile(Base, ManagedMixin):
 
     @property
     def size(self):
+        if self.streaming:
+            return self.spool_size
         return len(self.body)
 
     def add_hosters(self, hosters):
@@ -460,26 +754,45 @@ class RenterFile(Base, ManagedMixin):
         self.save()
 
     @classmethod
-    def refresh_from_contract(cls):
+    async def refresh_from_contract(cls):
+        """
+        Sync files with the Client contract: names and hosts of all files are read in one batch request,
+        hosts are resolved and files with their hosters are loaded with one query each.
+        """
         with contextlib.suppress(AttributeError):
-            files = client_contract.get_files()
-            for file_hash in files:
-                cls.update_or_create(
-                    name=client_contract.get_file_name(file_hash),
-                    hash_=file_hash,
-                    hosts=client_contract.get_file_hosts(file_hash),
-                    status=cls.UPLOADED
-                )
-            for file in cls.objects.all():
-                if file.hash not in files:
-                    file.delete()
+            files = await client_contract.get_files()
+            info = await client_contract.get_files_info(files)
+            addresses = [address for _, file_hosts in info.values() for address in file_hosts]
+            hosts = {host.address.lower(): host for host in await Host.get_or_create_many(addresses)}
+            await run_db(cls._apply_files_info, info, hosts)
+
+    @classmethod
+    def _apply_files_info(cls, info: dict, hosts: dict):
+        existing = {f.hash: f for f in session.query(cls).options(selectinload(cls.hosters))}
+        for file_hash, (name, file_hosts) in info.items():
+            instance = existing.get(file_hash)
+            if instance is None:
+                instance = cls(name=name, hash_=file_hash, encrypted=True, status=cls.UPLOADED)
+            else:
+                instance.name = name
+            known = set(instance.hosters)
+            for address in file_hosts:
+                host = hosts[address.lower()]
+                if host not in known:
+                    instance.hosters.append(host)
+                    known.add(host)
+            instance.save()
+        for file_hash, file in existing.items():
+            if file_hash not in info:
+                file.delete()
+        commit()  # queries of the caller see the synced files, changes are not autoflushed
 
     async def to_json(self):
         res = {c.name: str(getattr(self, c.name)) for c in self.__table__.columns}
         try:
-            name = decrypt(
+            name = (await decrypt_async(
                 self.name.encode('utf-8') if isinstance(self.name, bytes) else self.name.encode('utf-8')
-            ).decode('utf-8')
+            )).decode('utf-8')
         except DecryptionError:
             name = self.name
         res['name'] = name
@@ -491,8 +804,8 @@ class RenterFile(Base, ManagedMixin):
                                                  hours=(
                                                          await token_contract.get_deposit(file_hash=self.hash) /
                                                          (
-                                                                 token_contract.tokens_per_byte_hour *
-                                                                 client_contract.get_file_size(self.hash) *
+                                                                 await token_contract.get_tokens_per_byte_hour() *
+                                                                 await client_contract.get_file_size(self.hash) *
                                                                  10  # hosters per file
                                                          )
                                                  )
@@ -507,7 +820,7 @@ class HosterFileM2M(Base, ManagedMixin):
     INIT, ACTIVE, OFFLINE, SYNC, REMOVED = 'init', 'active', 'offline', 'sync', 'removed'
     __tablename__ = 'hoster_files_m2m'
     file_id = Column(Integer, ForeignKey('hoster_files.id'), primary_key=True)
-    host_id = Column(Integer, ForeignKey('hosts.id'), primary_key=True)
+    host_id = Column(Integer, ForeignKey('hosts.id'), primary_key=True, index=True)
     time = Column(TIMESTAMP, default=datetime.utcnow)
     last_ping = Column(TIMESTAMP, nullable=True)
     status = Column(String(32), default=ACTIVE)
@@ -549,11 +862,35 @@ class HosterFileM2M(Base, ManagedMixin):
         except NoResultFound:
             raise cls.NotFound
 
+    @classmethod
+    async def get_status_async(cls, file_hash, host_address):
+        return await run_db(cls.get_status, file_hash, host_address)
+
+    @classmethod
+    def get_statuses(cls, pairs) -> dict:
+        """
+        :param pairs: [(file hash, host address)]
+        :return: {(file hash, host address): status} of the pairs that exist
+        """
+        pairs = set(pairs)
+        if not pairs:
+            return {}
+        query = session.query(HosterFile.hash, Host.address, cls.status) \
+            .join(cls.file) \
+            .join(cls.host) \
+            .filter(HosterFile.hash.in_({hash_ for hash_, _ in pairs})) \
+            .filter(Host.address.in_({address for _, address in pairs}))
+        return {(hash_, address): status for hash_, address, status in query if (hash_, address) in pairs}
+
+    @classmethod
+    async def get_statuses_async(cls, pairs) -> dict:
+        return await run_db(cls.get_statuses, pairs)
+
 
 class RenterFileM2M(Base, ManagedMixin):
     __tablename__ = 'renter_files_m2m'
     file_id = Column(Integer, ForeignKey('renter_files.id'), primary_key=True)
-    host_id = Column(Integer, ForeignKey('hosts.id'), primary_key=True)
+    host_id = Column(Integer, ForeignKey('hosts.id'), primary_key=True, index=True)
     file = relationship(RenterFile, backref=backref("renter_files_assoc"))
     host = relationship(Host, backref=backref("rf_hosts_assoc"))
 
@@ -575,7 +912,7 @@ class Stats(Base, ManagedMixin):
     @classmethod
     def load(cls):
         try:
-            instance = session.query(cls).one()
+            instance = cls.find_pending(lambda obj: True) or session.query(cls).order_by(cls.id).limit(1).one()
             return instance
         except NoResultFound:
             instance = cls()
@@ -584,7 +921,8 @@ class Stats(Base, ManagedMixin):
 
     @classmethod
     def get_host_list_sync_time(cls):
-        return cls.load().host_list_sync_time
+        # Read only: units of work running concurrently must not each create the row.
+        return session.query(cls.host_list_sync_time).order_by(cls.id).limit(1).scalar()
 
     @classmethod
     def update_host_list_sync_time(cls):
@@ -1,15 +1,153 @@
-from sqlalchemy import create_engine
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from functools import partial
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, scoped_session
 
 from settings import settings
 
-engine = create_engine(f'sqlite:///{settings.db_path}')
-Session = sessionmaker(bind=engine)
+# Connections are used by the event loop thread and the DB thread, see run_db.
+engine = create_engine(f'sqlite:///{settings.db_path}', connect_args={'check_same_thread': False})
+
+
+@event.listens_for(engine, 'connect')
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    WAL lets readers work while a unit of work commits; with WAL, synchronous=NORMAL
+    still keeps the database consistent on power loss and fsyncs only on checkpoints.
+    """
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.execute('PRAGMA cache_size=-8000')  # KiB
+    cursor.close()
+
+
+# Changes are sent to the database only on commit, so a unit of work does not hold
+# the SQLite write lock while it awaits network calls.
+Session = sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
 
 Base = declarative_base()
 
-session = Session()
+
+class _Unit:
+    def __init__(self) -> None:
+        self.active = True
+        self.task = _current_task()
+
+
+def _current_task():
+    try:
+        return asyncio.current_task()
+    except RuntimeError:  # no running event loop
+        return None
+
+
+_DEFAULT_SCOPE = object()
+_current_unit = ContextVar('unit_of_work', default=None)
+
+
+def _scope():
+    unit = _current_unit.get()
+    return unit if unit is not None and unit.active else _DEFAULT_SCOPE
+
+
+# Session of the current unit of work, or the shared default session outside of one.
+session = scoped_session(Session, scopefunc=_scope)
+
+
+def in_unit_of_work():
+    return _scope() is not _DEFAULT_SCOPE
+
+
+# One thread for all blocking database work of coroutines: SQLite takes one writer at a time anyway,
+# and a session is never used by two threads at once.
+_db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db')
+
+
+async def run_db(fn, *args, **kwargs):
+    """
+    Run blocking database code on the DB thread, in the caller's unit of work.
+    """
+    context = contextvars.copy_context()
+    return await asyncio.get_event_loop().run_in_executor(_db_executor, partial(context.run, fn, *args, **kwargs))
+
+
+class unit_of_work:
+    """
+    Run a request handler or a monitoring pass with its own session.
+    Model changes are collected and committed once on exit, or rolled back on error.
+    Use `async with` in coroutines to commit on the DB thread.
+    Nested units in the same task join the outer unit. Tasks spawned from a unit
+    see its session while it is open and fall back to the default session after it ends.
+    """
+
+    def __init__(self) -> None:
+        self._unit = None
+        self._token = None
+
+    def __enter__(self):
+        unit = _current_unit.get()
+        if unit is None or not unit.active or unit.task is not _current_task():
+            self._unit = _Unit()
+            self._token = _current_unit.set(self._unit)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self._unit is not None:
+            try:
+                self._end(exc_type is None)
+            finally:
+                self._reset()
+
+    async def __aenter__(self):
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        if self._unit is not None:
+            try:
+                await run_db(self._end, exc_type is None)
+            finally:
+                self._reset()
+
+    @staticmethod
+    def _end(ok):
+        try:
+            if ok:
+                session.commit()
+            else:
+                session.rollback()
+        except BaseException:
+            session.rollback()
+            raise
+        finally:
+            session.remove()
+
+    def _reset(self):
+        self._unit.active = False
+        _current_unit.reset(self._token)
+
+
+def commit():
+    """
+    Commit changes made so far, for results that must be visible to others before the unit of work ends
+    or whose IntegrityError must be handled in place.
+    """
+    try:
+        session.commit()
+    except IntegrityError:
+        session.rollback()
+        raise
+
+
+async def commit_async():
+    return await run_db(commit)
 
 
 def create_tables():
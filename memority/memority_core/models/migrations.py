@@ -0,0 +1,24 @@
+from sqlalchemy import text
+
+__all__ = ['migrate']
+
+# Schema changes for databases created by older versions, applied in order.
+# The number of applied migrations is kept in SQLite's PRAGMA user_version.
+# Fresh databases get the same schema from the models, so statements must be idempotent.
+MIGRATIONS = [
+    # 1: indexes for lowercased host address lookups and m2m joins by host
+    [
+        'CREATE INDEX IF NOT EXISTS ix_hosts_address_lower ON hosts (lower(address))',
+        'CREATE INDEX IF NOT EXISTS ix_hoster_files_m2m_host_id ON hoster_files_m2m (host_id)',
+        'CREATE INDEX IF NOT EXISTS ix_renter_files_m2m_host_id ON renter_files_m2m (host_id)',
+    ],
+]
+
+
+def migrate(engine):
+    with engine.begin() as connection:
+        version = connection.execute(text('PRAGMA user_version')).scalar()
+        for number, statements in enumerate(MIGRATIONS[version:], start=version + 1):
+            for statement in statements:
+                connection.execute(text(statement))
+            connection.execute(text(f'PRAGMA user_version = {number}'))
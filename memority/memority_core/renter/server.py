@@ -2,12 +2,13 @@ import contextlib
 import json
 import renter.views
 import traceback
-from aiohttp import web, WSMsgType
+from aiohttp import web, WSMsgType, hdrs
 from asyncio import CancelledError
 from bugtracking import raven_client
 from functools import partial
+from models import unit_of_work
 from settings import settings
-from utils import check_first_run
+from utils import check_first_run, setup_peer_session
 
 from .views import *
 
@@ -56,7 +57,8 @@ async def websocket_handler(request):
                 handler = VIEWS.get(data.get('command'), None)
                 if handler:
                     try:
-                        resp = await handler(**data.get('kwargs', {}))
+                        async with unit_of_work():
+                            resp = await handler(**data.get('kwargs', {}))
                     except settings.Locked:
                         resp = {
                             "status": "action_needed",
@@ -129,8 +131,18 @@ async def allowed_hosts_middleware(request, handler):
     return await handler(request)
 
 
+@web.middleware
+async def unit_of_work_middleware(request, handler):
+    # Websocket connections live long, every command gets its own unit of work instead.
+    if request.headers.get(hdrs.UPGRADE, '').lower() == 'websocket':
+        return await handler(request)
+    async with unit_of_work():
+        return await handler(request)
+
+
 def create_renter_app():
-    app = web.Application(middlewares=[allowed_hosts_middleware, error_middleware])
+    app = web.Application(middlewares=[allowed_hosts_middleware, error_middleware, unit_of_work_middleware])
+    setup_peer_session(app)
     app.router.add_route('GET', '/', websocket_handler)
     app.router.add_route('GET', '/ping/', ping_handler)
     app.router.add_route('GET', '/files/', list_files)
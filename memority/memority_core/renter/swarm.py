@@ -0,0 +1,170 @@
+import asyncio
+import logging
+import random
+from collections import deque
+
+import aiofiles
+
+from settings import settings
+from utils import compute_hash_async, get_peer_session
+
+__all__ = ['SwarmDownload']
+
+logger = logging.getLogger('memority')
+
+
+class SwarmDownload:
+    """
+    Parallel ranged download of one box from several hosters.
+
+    The ciphertext is split into fixed-size byte ranges and every hoster gets a worker
+    pulling ranges from a shared queue. A range that times out, fails or does not match
+    the storage proof of another hoster goes back to the queue for the other workers.
+    When the queue is empty, idle workers duplicate ranges still in flight on slower
+    hosters and the first verified copy wins.
+    Ranges are written at their offsets into `part_path`, so memory stays bounded.
+    """
+    MAX_HOSTER_FAILURES = 3
+    VERIFIERS_PER_RANGE = 2
+
+    def __init__(self, file_hash, size, hosters, part_path, *, range_size=None, range_timeout=None) -> None:
+        self.file_hash = file_hash
+        self.size = size
+        self.hosters = list(hosters)
+        self.part_path = part_path
+        self.range_size = range_size or settings.download_range_size
+        self.range_timeout = range_timeout or settings.download_range_timeout
+        self.ranges = [
+            (start, min(start + self.range_size, size))
+            for start in range(0, size, self.range_size)
+        ]
+        self._pending = deque(range(len(self.ranges)))
+        self._in_flight = {}  # range index -> addresses of hosters fetching it
+        self._failed_by = {}  # range index -> addresses of hosters that failed it
+        self._done = set()
+        self._changed = asyncio.Event()
+        self._write_lock = asyncio.Lock()
+
+    @property
+    def complete(self):
+        return len(self._done) == len(self.ranges)
+
+    async def run(self) -> bool:
+        """
+        :return: <bool> whether every range is downloaded and verified
+        """
+        with open(self.part_path, 'wb') as f:
+            f.truncate(self.size)
+        session = get_peer_session()
+        async with aiofiles.open(self.part_path, 'r+b') as part:
+            await asyncio.wait([
+                asyncio.ensure_future(self._worker(session, part, hoster))
+                for hoster in self.hosters
+            ])
+        return self.complete
+
+    async def iter_part(self):
+        async with aiofiles.open(self.part_path, 'rb') as f:
+            chunk = await f.read(64 * 1024)
+            while chunk:
+                yield chunk
+                chunk = await f.read(64 * 1024)
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _can_fetch(self, index, address):
+        return (
+            index not in self._done and
+            address not in self._in_flight.get(index, ()) and
+            address not in self._failed_by.get(index, ())
+        )
+
+    def _next_range(self, address):
+        for index in self._pending:
+            if self._can_fetch(index, address):
+                self._pending.remove(index)
+                return index
+        # End game: help with the range that has the fewest fetchers.
+        candidates = [i for i in self._in_flight if self._can_fetch(i, address)]
+        if candidates:
+            return min(candidates, key=lambda i: len(self._in_flight[i]))
+        return None
+
+    async def _worker(self, session, part, hoster):
+        failures = 0
+        while not self.complete and failures < self.MAX_HOSTER_FAILURES:
+            index = self._next_range(hoster.address)
+            if index is None:
+                if not self._in_flight:
+                    break
+                await self._changed.wait()
+                continue
+
+            start, stop = self.ranges[index]
+            self._in_flight.setdefault(index, set()).add(hoster.address)
+            try:
+                data = await asyncio.wait_for(self._fetch(session, hoster, start, stop), self.range_timeout)
+                ok = index in self._done or await self._verify(session, hoster, start, stop, data)
+            except Exception as err:
+                logger.warning(f'Range download failed | file: {self.file_hash} | hoster: {hoster.address} '
+                               f'| range: {start}-{stop} | message: {err.__class__.__name__} {str(err)}')
+                ok, data = False, None
+            finally:
+                self._in_flight[index].discard(hoster.address)
+
+            if ok and index not in self._done:
+                async with self._write_lock:
+                    await part.seek(start)
+                    await part.write(data)
+                self._done.add(index)
+                failures = 0
+            elif not ok:
+                failures += 1
+                self._failed_by.setdefault(index, set()).add(hoster.address)
+                if index not in self._done and not self._in_flight[index] and index not in self._pending:
+                    self._pending.append(index)
+            if not self._in_flight[index]:
+                del self._in_flight[index]
+            self._notify()
+
+    async def _fetch(self, session, hoster, start, stop) -> bytes:
+        async with session.get(
+                f'http://{hoster.ip}/files/{self.file_hash}/',
+                headers={'Range': f'bytes={start}-{stop - 1}'}) as resp:
+            if not resp.status == 206:
+                raise Exception(f'{resp.status} != 206')
+            data = await resp.read()
+        if len(data) != stop - start:
+            raise Exception(f'Invalid range length | expected: {stop - start} | got: {len(data)}')
+        return data
+
+    async def _verify(self, session, source, start, stop, data) -> bool:
+        """
+        Compare the range hash with the storage proof of other hosters.
+        Falls back to accepting the range if no other hoster answers:
+        chunk frames are authenticated on decryption anyway.
+        """
+        verifiers = [h for h in self.hosters if h.address != source.address]
+        random.shuffle(verifiers)
+        for verifier in verifiers[:self.VERIFIERS_PER_RANGE]:
+            try:
+                proof = await asyncio.wait_for(self._get_proof(session, verifier, start, stop), self.range_timeout)
+            except Exception:
+                continue
+            if proof != await compute_hash_async(data):
+                logger.warning(f'Range verification failed | file: {self.file_hash} | hoster: {source.address} '
+                               f'| verifier: {verifier.address} | range: {start}-{stop}')
+                return False
+            return True
+        logger.info(f'Range is not verified, no hoster answered | file: {self.file_hash} '
+                    f'| hoster: {source.address} | range: {start}-{stop}')
+        return True
+
+    async def _get_proof(self, session, hoster, start, stop):
+        async with session.get(f'http://{hoster.ip}/files/{self.file_hash}/proof/?from={start}&to={stop}') as resp:
+            if not resp.status == 200:
+                raise Exception(f'{resp.status} != 200')
+            resp_data = await resp.json()
+            return resp_data.get('data').get('hash')
@@ -3,17 +3,21 @@ import asyncio
 import contextlib
 import logging
 import os
+import tempfile
 from aiohttp import web, ClientConnectorError
 from functools import partial
 from sqlalchemy.exc import IntegrityError
 
 import smart_contracts
 from bugtracking import raven_client
-from models import Host, RenterFile
+from hoster.limits import monitoring_limits
+from models import Host, RenterFile, commit_async
 from settings import settings
-from smart_contracts import client_contract, token_contract, memo_db_contract, import_private_key_to_eth
+from smart_contracts import client_contract, token_contract, memo_db_contract, import_private_key_to_eth, \
+    contract_call_cache, run_w3, transaction_manager, get_client_contract
 from smart_contracts.smart_contract_api import wait_for_transaction_completion
-from utils import ask_for_password, check_first_run, DecryptionError, get_ip
+from utils import ask_for_password, check_first_run, DecryptionError, get_ip, get_peer_session
+from .swarm import SwarmDownload
 
 # ToDo: review if all these views are required
 
@@ -46,22 +50,23 @@ async def upload_to_hoster(hoster, data, file, _logger=None):
         _logger = logger
     ip = hoster.ip
     _logger.info(f'Uploading file metadata to hoster... | file: {file.hash} | hoster ip: {ip}')
+    session = get_peer_session()
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(
-                    f'http://{ip}/files/',
-                    json=data,
-                    timeout=10) as resp1:
-                # ToDo: handle 402
-                if not resp1.status == 201:
-                    return hoster, False
-            _logger.info(f'Uploading file body to hoster... | file: {file.hash} | hoster ip: {ip}')
-            async with session.put(
-                    f'http://{ip}/files/{file.hash}/',
-                    data=file.get_filelike()) as resp2:
-                if not resp2.status == 200:
-                    await session.delete(f'http://{ip}/files/{file.hash}/')
-                    return hoster, False
+        async with session.post(
+                f'http://{ip}/files/',
+                json=data,
+                timeout=aiohttp.ClientTimeout(total=10)) as resp1:
+            # ToDo: handle 402
+            if not resp1.status == 201:
+                return hoster, False
+        _logger.info(f'Uploading file body to hoster... | file: {file.hash} | hoster ip: {ip}')
+        async with session.put(
+                f'http://{ip}/files/{file.hash}/',
+                data=file.get_filelike()) as resp2:
+            if not resp2.status == 200:
+                async with session.delete(f'http://{ip}/files/{file.hash}/'):
+                    pass
+                return hoster, False
         _logger.info(f'File is uploaded to hoster | file: {file.hash} | hoster ip: {ip}')
         return hoster, True
     except (ClientConnectorError, asyncio.TimeoutError) as err:
@@ -79,16 +84,15 @@ async def upload_file_host_list_to_hoster(hoster, data, file):
     ip = hoster.ip
     logger.info(f'Uploading file host list | file: {file.hash} | hoster ip: {ip}')
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.put(
-                    f'http://{ip}/files/{file.hash}/metadata/',
-                    json=data) as resp:
-                if not resp.status == 200:
-                    resp_data = await resp.read()
-                    logger.warning(f'Uploading host list to hoster failed | file: {file.hash} '
-                                   f'| hoster: {hoster.address} '
-                                   f'| message: {resp_data}')
-                    return hoster, False
+        async with get_peer_session().put(
+                f'http://{ip}/files/{file.hash}/metadata/',
+                json=data) as resp:
+            if not resp.status == 200:
+                resp_data = await resp.read()
+                logger.warning(f'Uploading host list to hoster failed | file: {file.hash} '
+                               f'| hoster: {hoster.address} '
+                               f'| message: {resp_data}')
+                return hoster, False
         logger.info(f'File host list is uploaded | file: {file.hash} | hoster ip: {ip}')
         return hoster, True
     except Exception as err:
@@ -107,21 +111,29 @@ async def upload_file(**kwargs):
         return _error_response("path is not specified")
 
     file = await RenterFile.open(path)
+    try:
+        return await _upload_file(file, path)
+    finally:
+        file.discard_spool()
+
+
+async def _upload_file(file: RenterFile, path):
     try:
         logger.info(f'Preparing file for uploading | path: {path}')
         await notify_user(f'Preparing file for uploading | path: {path}')
-        file.prepare_to_uploading()
+        await file.prepare_to_uploading()
     except IntegrityError:
-        if file.hash in client_contract.get_files():
+        if file.hash in await client_contract.get_files():
             logger.warning(f'The file is already uploaded | path: {path} | hash: {file.hash}')
             return _error_response("The file is already uploaded!")
 
     if not await token_contract.get_deposit(file_hash=file.hash):
-        token_balance = token_contract.get_mmr_balance()
+        token_balance = await token_contract.get_mmr_balance()
+        tokens_per_byte_hour = await token_contract.get_tokens_per_byte_hour()
         tokens_to_deposit = await ask_user_for__(
             'tokens_to_deposit',
             'Choose token amount for file deposit\n'
-            f'({token_contract.wmmr_to_mmr(token_contract.tokens_per_byte_hour*file.size*10*24*14)} MMR for 2 weeks)',
+            f'({await token_contract.wmmr_to_mmr(tokens_per_byte_hour*file.size*10*24*14)} MMR for 2 weeks)',
             type_='float'
         )
         if not tokens_to_deposit:
@@ -135,11 +147,12 @@ async def upload_file(**kwargs):
         await client_contract.make_deposit(value=tokens_to_deposit, file_hash=file.hash)
 
         if not await token_contract.get_deposit(file_hash=file.hash):
-            file.delete()
+            await file.delete_async()
             return _error_response(f'Failed deposit creation | file: {file.hash}')
         await notify_user('Deposit successfully created.')
 
     file.update_status(RenterFile.UPLOADING)
+    await commit_async()  # the status is shown in the file list while uploading
 
     # region Upload to 10 hosters
     data = {
@@ -151,10 +164,10 @@ async def upload_file(**kwargs):
     }
 
     logger.info('Trying to get hoster list')
-    hosters = set(Host.get_n(n=10))
+    hosters = set(await Host.get_n(n=10))
     if not hosters:
         logger.error(f'No hosters available | file: {file.hash}')
-        file.delete()
+        await file.delete_async()
         return _error_response("No hosters available!")
     logger.info(f'Uploading to hosters | file: {file.hash} '
                 f'| hosters: {", ".join([hoster.address for hoster in hosters])}')
@@ -185,14 +198,14 @@ async def upload_file(**kwargs):
         else:
             logger.info(f'Failed uploading to some hosters | file: {file.hash} '
                         f'| hosters: {", ".join([hoster.address for hoster in hosts_error])}')
-            hosters = set(Host.get_n(n=10 - len(hosts_success))) \
+            hosters = set(await Host.get_n(n=10 - len(hosts_success))) \
                 .difference(hosts_success) \
                 .difference(hosts_error)
             if not hosters:
                 if hosts_success:
                     break
                 logger.error(f'No hosters available | file: {file.hash}')
-                file.delete()
+                await file.delete_async()
                 return _error_response("No hosters available!")
 
     hosters = hosts_success
@@ -202,6 +215,7 @@ async def upload_file(**kwargs):
     await notify_user('Uploaded.')
     # endregion
     file.update_status(RenterFile.UPLOADED)
+    await commit_async()
 
     # region Save file metadata to contract
     file_metadata_for_contract = {
@@ -218,11 +232,11 @@ async def upload_file(**kwargs):
         await client_contract.add_hosts(**file_metadata_for_contract)
     except Exception as err:
         raven_client.captureException()
-        async with aiohttp.ClientSession() as session:
-            for hoster in hosters:
-                await session.delete(f'http://{hoster.ip}/files/{file.hash}/')
+        session = get_peer_session()
+        for hoster in hosters:
+            async with session.delete(f'http://{hoster.ip}/files/{file.hash}/'):
                 logger.info(f'Deleted from hoster | file: {file.hash} | hoster ip: {hoster.ip}')
-        file.delete()
+        await file.delete_async()
         logger.warning(f'Saving data to contract failed | file: {file.hash} '
                        f'| message: {err.__class__.__name__} {str(err)}')
         return _error_response(f'Saving data to contract failed | file: {file.hash} '
@@ -283,73 +297,117 @@ async def download_file(**kwargs):
         return _error_response("hash is not specified")
 
     try:
-        file = RenterFile.find(hash_=file_hash)
+        file = await RenterFile.find_async(hash_=file_hash)
     except RenterFile.NotFound:
         logger.warning(f'File not found | {file_hash}')
         return _error_response(f"A file with '{file_hash}' hash is not found!")
 
     file_hosters = file.hosters
-    for hoster in file_hosters:
-        logger.info(f'Trying to download file... | file: {file_hash} | hoster: {hoster.address}')
-        await notify_user(f'Trying to download file... | file: {file_hash} | hoster: {hoster.address}')
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(f'http://{hoster.ip}/files/{file_hash}/') as response:
-                    assert response.status == 200
-                    file_body = await response.read()
-        except Exception as err:
-            logger.warning(f'Downloading from hoster failed | file: {file_hash} | hoster: {hoster.address} '
-                           f'| message: {err.__class__.__name__} {str(err)}')
-            continue
-
-        file.load_body(file_body)
-        logger.info(f'Decrypting file | file: {file_hash} | hoster: {hoster.address}')
-        try:
-            file.decrypt()
-        except DecryptionError:
-            if os.getenv('mmr_debug', None):
-                import pdb
-                pdb.set_trace()
-            logger.error(
-                f'Failed file decrypting | file: {file_hash} | hoster: {hoster.address}',
-                extra={
-                    'stack': True,
-                }
-            )
-            continue
-        logger.info(f'File successfully downloaded and decrypted | file: {file_hash} | hoster: {hoster.address}')
-        await notify_user(f'File successfully downloaded and decrypted | file: {file_hash} | hoster: {hoster.address}')
-        break
-    else:
-        logger.warning(f"Downloading from each of {len(file_hosters)} hosters failed! "
-                       f"| file: {file_hash} | hosters: {', '.join([h.address for h in file_hosters])}")
-        return _error_response(f"Downloading from each of {len(file_hosters)} hosters failed! "
-                               f"| file: {file_hash} | hosters: {', '.join([h.address for h in file_hosters])}")
-
     try:
-        await file.save_to_fs(destination=destination)
+        downloaded = await _download_from_swarm(file, file_hosters, destination)
     except FileExistsError:
-        # ToDo: overwrite existing?
         logger.warning(f'File already exists in filesystem | file: {file_hash}')
         return _error_response("The file already exists! Please specify a different path.")
     except PermissionError as err:
         logger.warning(str(err))
         return _error_response(str(err))
+    except DecryptionError:
+        logger.error(
+            f'Failed file decrypting | file: {file_hash} | hosters: {", ".join([h.address for h in file_hosters])}',
+            extra={
+                'stack': True,
+            }
+        )
+        downloaded = False
+
+    if not downloaded:
+        for hoster in file_hosters:
+            logger.info(f'Trying to download file... | file: {file_hash} | hoster: {hoster.address}')
+            await notify_user(f'Trying to download file... | file: {file_hash} | hoster: {hoster.address}')
+            try:
+                async with get_peer_session().get(f'http://{hoster.ip}/files/{file_hash}/') as response:
+                    assert response.status == 200
+                    logger.info(f'Downloading and decrypting file | file: {file_hash} | hoster: {hoster.address}')
+                    await file.save_stream_to_fs(
+                        response.content.iter_chunked(64 * 1024),
+                        destination=destination
+                    )
+            except FileExistsError:
+                # ToDo: overwrite existing?
+                logger.warning(f'File already exists in filesystem | file: {file_hash}')
+                return _error_response("The file already exists! Please specify a different path.")
+            except PermissionError as err:
+                logger.warning(str(err))
+                return _error_response(str(err))
+            except DecryptionError:
+                if os.getenv('mmr_debug', None):
+                    import pdb
+                    pdb.set_trace()
+                logger.error(
+                    f'Failed file decrypting | file: {file_hash} | hoster: {hoster.address}',
+                    extra={
+                        'stack': True,
+                    }
+                )
+                continue
+            except Exception as err:
+                logger.warning(f'Downloading from hoster failed | file: {file_hash} | hoster: {hoster.address} '
+                               f'| message: {err.__class__.__name__} {str(err)}')
+                continue
+
+            logger.info(f'File successfully downloaded and decrypted | file: {file_hash} | hoster: {hoster.address}')
+            await notify_user(f'File successfully downloaded and decrypted '
+                              f'| file: {file_hash} | hoster: {hoster.address}')
+            break
+        else:
+            logger.warning(f"Downloading from each of {len(file_hosters)} hosters failed! "
+                           f"| file: {file_hash} | hosters: {', '.join([h.address for h in file_hosters])}")
+            return _error_response(f"Downloading from each of {len(file_hosters)} hosters failed! "
+                                   f"| file: {file_hash} | hosters: {', '.join([h.address for h in file_hosters])}")
 
     logger.info(f'Finished file downloading | file: {file_hash}')
-    await notify_user(f'Finished file downloading | file: {os.path.join(destination, file.name)}')
+    await notify_user(f'Finished file downloading | file: {file.destination_path(destination)}')
 
     return {
         "status": "success",
         "details": "downloaded",
         "data": {
             "file": {
-                "name": os.path.join(destination, file.name)
+                "name": file.destination_path(destination)
             }
         }
     }
 
 
+async def _download_from_swarm(file: RenterFile, hosters, destination):
+    """
+    Download the file by ranges from all its hosters at once, see SwarmDownload.
+    :return: <bool> False if the swarm is not applicable or failed, so that caller falls back to one hoster
+    """
+    if len(hosters) < 2:
+        return False
+    size = await client_contract.get_file_size(file.hash)
+    if size <= settings.download_range_size:
+        return False
+    if os.path.isfile(file.destination_path(destination)):
+        raise FileExistsError
+    fd, part_path = tempfile.mkstemp(dir=settings.tmp_dir, suffix='.download')
+    os.close(fd)
+    try:
+        logger.info(f'Downloading file from {len(hosters)} hosters | file: {file.hash} | size: {size}')
+        await notify_user(f'Downloading file from {len(hosters)} hosters | file: {file.hash}')
+        swarm = SwarmDownload(file.hash, size, hosters, part_path)
+        if not await swarm.run():
+            logger.warning(f'Downloading from hosters swarm failed | file: {file.hash}')
+            return False
+        await file.save_stream_to_fs(swarm.iter_part(), destination=destination)
+        logger.info(f'File successfully downloaded and decrypted | file: {file.hash}')
+        return True
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(part_path)
+
+
 async def list_files(request):
     if check_first_run():
         return web.json_response({
@@ -359,7 +417,7 @@ async def list_files(request):
                 "files": []
             }
         })
-    RenterFile.refresh_from_contract()
+    await RenterFile.refresh_from_contract()
     logger.info('List files')
     await asyncio.sleep(0)  # for await list_files
     return web.json_response({
@@ -377,7 +435,11 @@ async def view_config(request: web.Request, *args, **kwargs):
         if name in ['private_key', 'encryption_key']:
             return web.json_response({"status": "error", "details": "forbidden"})
         if name == 'host_ip':
-            res = memo_db_contract.get_host_ip(settings.address)
+            res = await memo_db_contract.get_host_ip(settings.address)
+        elif name == 'contract_cache':
+            res = contract_call_cache.stats()
+        elif name == 'monitoring_limits':
+            res = monitoring_limits.stats()
         else:
             res = settings.__getattr__(name)
         if res:
@@ -409,12 +471,12 @@ async def view_user_info(request: web.Request):
     attr = request.match_info.get('attr')
     if attr == 'balance':
         if settings.address:
-            res = token_contract.get_mmr_balance()
+            res = await token_contract.get_mmr_balance()
         else:
             res = None
     elif attr == 'role':
         client, host = None, None
-        if memo_db_contract.get_host_ip(settings.address):
+        if await memo_db_contract.get_host_ip(settings.address):
             host = True
         if settings.client_contract_address:
             client = True
@@ -445,7 +507,8 @@ async def create_account(request: web.Request):
             password = data.get('password')
             settings.generate_keys(password)
             smart_contracts.smart_contract_api.ask_for_password = partial(ask_for_password, password)
-            import_private_key_to_eth(password, settings.private_key)
+            transaction_manager.reset()
+            await run_w3(import_private_key_to_eth, password, settings.private_key)
             return web.json_response(
                 {"status": "success", "address": settings.address},
                 status=201
@@ -490,11 +553,13 @@ async def unlock(request: web.Request):
     global w3
     w3 = smart_contracts.smart_contract_api.create_w3()
     smart_contracts.smart_contract_api.w3 = w3
-    client_contract.reload()
-    token_contract.reload()
-    memo_db_contract.reload()
-    if settings.address.lower() not in [a.lower() for a in w3.eth.accounts]:
-        import_private_key_to_eth(password=password)
+    transaction_manager.reset()
+    get_client_contract.cache_clear()
+    await run_w3(client_contract.reload)
+    await run_w3(token_contract.reload)
+    await run_w3(memo_db_contract.reload)
+    if settings.address.lower() not in [a.lower() for a in await run_w3(lambda: w3.eth.accounts)]:
+        await run_w3(import_private_key_to_eth, password=password)
     return web.json_response({"status": "success"})
 
 
@@ -519,7 +584,7 @@ async def request_mmr(request):
                 return web.json_response(
                     {
                         "status": "success",
-                        "balance": token_contract.get_mmr_balance()
+                        "balance": await token_contract.get_mmr_balance()
                     }
                 )
             else:
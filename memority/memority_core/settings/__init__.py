@@ -5,6 +5,7 @@ import platform
 import random
 import shutil
 import string
+import time
 from shutil import copyfile
 
 import ecdsa
@@ -39,6 +40,67 @@ def get_user_home_dir():
     return __user_home_dir()
 
 
+def _app_dir(name):
+    path = os.path.join(_app_data_dir, name)
+    if path not in _created_dirs:
+        if not os.path.exists(path):
+            os.makedirs(path)
+        _created_dirs.add(path)
+    return path
+
+
+_SECRET_KEYS = ['encryption_key', 'public_key', 'private_key', 'address', 'client_contract_address']
+
+
+class _FileCache:
+    """
+    Parsed settings files, re-read only when the file's mtime or size changes.
+    Each file is stat'ed at most once per `check_interval` seconds,
+    writes made through Settings update the cache directly.
+    """
+
+    def __init__(self, check_interval=1.0) -> None:
+        self.check_interval = check_interval
+        self._stamps = {}  # path -> (checked at, stamp)
+        self._values = {}  # key -> (stamp, value)
+
+    def stamp(self, path):
+        """
+        :return: (mtime, size) of the file or None if it does not exist
+        """
+        now = time.monotonic()
+        checked = self._stamps.get(path)
+        if checked and now - checked[0] < self.check_interval:
+            return checked[1]
+        try:
+            stat = os.stat(path)
+            stamp = (stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            stamp = None
+        self._stamps[path] = (now, stamp)
+        return stamp
+
+    def get(self, path, load, key=None):
+        key = key or path
+        stamp = self.stamp(path)
+        cached = self._values.get(key)
+        if cached and cached[0] == stamp:
+            return cached[1]
+        value = load()
+        self._values[key] = (stamp, value)
+        return value
+
+    def put(self, path, value, key=None):
+        self.touch(path)
+        self._values[key or path] = (self.stamp(path), value)
+
+    def touch(self, path):
+        """
+        Stat the file on next access, for files replaced outside of Settings.
+        """
+        self._stamps.pop(path, None)
+
+
 class Settings:
     class Locked(Exception):
         ...
@@ -52,29 +114,21 @@ class Settings:
         self.dump(data)
 
     def __getattr__(self, item):
-        if item in [
-            'encryption_key',
-            'public_key',
-            'private_key',
-            'address',
-            'client_contract_address'
-        ] and os.path.isfile(self.local_settings_secrets_path):
+        if item in _SECRET_KEYS and _cache.stamp(self.local_settings_secrets_path) is not None:
             if not hasattr(self, 'password'):
                 raise self.Locked
             if not self.password:
                 raise self.Locked
-            data = self.read_encrypted()
-        else:
-            data = self.load()
-        try:
-            return data[item]
-        except KeyError:
-            return None
+            return self._read_encrypted_cached().get(item)
+        local_s = _cache.get(_local_settings_path, self.load_locals)
+        if item in local_s:
+            return local_s[item]
+        return _cache.get(_default_settings_path, self.load_defaults).get(item)
 
     def __hasattr__(self, a):
         return (
                 a in self.load() or (
-                    a in ['encryption_key', 'public_key', 'private_key', 'address', 'client_contract_address']
+                    a in _SECRET_KEYS
                     if os.path.isfile(self.local_settings_secrets_path)
                     else False
                 )
@@ -84,6 +138,8 @@ class Settings:
         super().__setattr__('password', password)
         self.read_encrypted()
         self.encrypt_secrets(self.load())
+        from utils import invalidate_key_cache
+        invalidate_key_cache()
 
     def change_password(self):
         ...  # ToDo: implement
@@ -95,10 +151,11 @@ class Settings:
         else:
             with open(self.local_settings_path, 'w') as outfile:
                 yaml.dump(data, outfile, default_flow_style=False)
+            _cache.put(_local_settings_path, dict(data))
 
     def encrypt_secrets(self, data):
         data_to_enc = {}
-        for key in ['encryption_key', 'public_key', 'private_key', 'address', 'client_contract_address']:
+        for key in _SECRET_KEYS:
             val = data.pop(key, None)
             if val:
                 data_to_enc[key] = val
@@ -117,10 +174,26 @@ class Settings:
         encrypted = encrypt(data.encode('utf-8'), password=self.password)
         with open(self.local_settings_secrets_path, 'wb') as outfile:
             outfile.write(encrypted)
+        _cache.put(
+            self.local_settings_secrets_path,
+            json.loads(data),
+            key=(self.local_settings_secrets_path, self.password)
+        )
+
+    def _read_encrypted_cached(self):
+        """
+        Decrypted secrets, decrypted again only when secrets.bin or the password change.
+        Callers must not modify the returned dict.
+        """
+        path = self.local_settings_secrets_path
+        return _cache.get(path, self._read_encrypted_file, key=(path, self.password))
 
     def read_encrypted(self):
         if not hasattr(self, 'password'):
             raise self.Locked
+        return dict(self._read_encrypted_cached())
+
+    def _read_encrypted_file(self):
         if not os.path.isfile(self.local_settings_secrets_path):
             return {}
         with open(self.local_settings_secrets_path, 'rb') as f:
@@ -155,6 +228,8 @@ class Settings:
             'private_key': private_key.to_string().hex(),
             'address': address,
         })
+        from utils import invalidate_key_cache
+        invalidate_key_cache()
 
     @staticmethod
     def load_defaults():
@@ -174,23 +249,21 @@ class Settings:
     @classmethod
     def load(cls):
         return {
-            **cls.load_defaults(),
-            **cls.load_locals()  # overwrite defaults if different
+            **_cache.get(_default_settings_path, cls.load_defaults),
+            **_cache.get(_local_settings_path, cls.load_locals)  # overwrite defaults if different
         }
 
     @property
     def boxes_dir(self):
-        path = os.path.join(_app_data_dir, 'boxes')
-        if not os.path.exists(path):
-            os.makedirs(path)
-        return path
+        return _app_dir('boxes')
+
+    @property
+    def tmp_dir(self):
+        return _app_dir('tmp')
 
     @property
     def log_dir(self):
-        path = os.path.join(_app_data_dir, 'logs')
-        if not os.path.exists(path):
-            os.makedirs(path)
-        return path
+        return _app_dir('logs')
 
     @property
     def db_path(self):
@@ -266,6 +339,9 @@ class Settings:
             os.path.join(filename),
             os.path.join(self.local_settings_secrets_path)
         )
+        _cache.touch(self.local_settings_secrets_path)
+        from utils import invalidate_key_cache
+        invalidate_key_cache()
         # endregion
 
     def export_account(self, filename):
@@ -281,5 +357,7 @@ _app_data_dir = get_app_data_dir()
 _user_home_dir = get_user_home_dir()
 _default_settings_path = os.path.join(_base_dir, "settings", "defaults.yml")
 _local_settings_path = os.path.join(_app_data_dir, "settings", "locals.yml")
+_cache = _FileCache()
+_created_dirs = set()
 
 settings = Settings()
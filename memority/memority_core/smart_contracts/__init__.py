@@ -1,3 +1,3 @@
 from .smart_contract_api import token_contract, client_contract, memo_db_contract, \
     import_private_key_to_eth, ask_for_password, \
-    ClientContract
+    ClientContract, get_client_contract, contract_call_cache, run_w3, transaction_manager
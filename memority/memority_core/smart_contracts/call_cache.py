@@ -0,0 +1,107 @@
+import inspect
+import time
+from functools import wraps
+
+__all__ = ['ContractCallCache', 'cached_call']
+
+
+class ContractCallCache:
+    """
+    Read-through cache of contract view calls, keyed by (contract address, method, args).
+    Entries expire after the TTL of their method; entries of methods cached per block
+    also expire as soon as a new block is seen.
+    """
+    BLOCK_CHECK_INTERVAL = 1.0  # seconds between block number requests
+
+    def __init__(self, block_number) -> None:
+        """
+        :param block_number: coroutine function returning the current block number
+        """
+        self._block_number = block_number
+        self._block = None
+        self._block_checked_at = 0
+        self._entries = {}  # key -> (expires at, block or None, value)
+        self.hits = 0
+        self.misses = 0
+
+    async def current_block(self):
+        now = time.monotonic()
+        if now - self._block_checked_at >= self.BLOCK_CHECK_INTERVAL:
+            self._block_checked_at = now  # concurrent callers use the last known block meanwhile
+            self._block = await self._block_number()
+        return self._block
+
+    def get(self, key, block=None):
+        """
+        :param block: current block for methods cached per block, see current_block
+        :return: <bool> hit, value
+        """
+        entry = self._entries.get(key)
+        if entry and entry[0] > time.monotonic() and entry[1] == block:
+            self.hits += 1
+            return True, entry[2]
+        self.misses += 1
+        return False, None
+
+    def put(self, key, value, ttl, block=None):
+        self._entries[key] = (time.monotonic() + ttl, block, value)
+
+    async def get_or_call(self, key, coro_fn, ttl, per_block=False):
+        block = await self.current_block() if per_block else None
+        hit, value = self.get(key, block)
+        if not hit:
+            value = await coro_fn()
+            self.put(key, value, ttl, block)
+        return value
+
+    def invalidate(self, address=None, method=None):
+        """
+        Drop entries of a contract and/or method, everything if called without arguments.
+        Called after transactions that change what the view calls return.
+        """
+        for key in list(self._entries):
+            if (address is None or key[0] == address) and (method is None or key[1] == method):
+                self._entries.pop(key, None)
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._entries),
+        }
+
+
+def cached_call(ttl, per_block=False):
+    """
+    Cache an async Contract view method in the module call cache, see ContractCallCache.
+    :param ttl: <int> seconds
+    :param per_block: <bool> also expire on a new block
+    """
+
+    def decorator(method):
+        signature = inspect.signature(method)
+
+        def key(self, *args, **kwargs):
+            """
+            Arguments are bound to the signature, so that positional, keyword and default
+            arguments of the same call share the cache entry.
+            """
+            bound = signature.bind(self, *args, **kwargs)
+            bound.apply_defaults()
+            return self.address, method.__name__, bound.args[1:] + tuple(sorted(bound.kwargs.items()))
+
+        @wraps(method)
+        async def wrapper(self, *args, **kwargs):
+            return await self.call_cache.get_or_call(
+                key(self, *args, **kwargs),
+                lambda: method(self, *args, **kwargs),
+                ttl,
+                per_block
+            )
+
+        wrapper.key = key
+        wrapper.ttl = ttl
+        wrapper.per_block = per_block
+        return wrapper
+
+    return decorator
@@ -0,0 +1,80 @@
+import json
+import socket
+import time
+
+from web3 import IPCProvider, HTTPProvider
+from web3.utils.compat import make_post_request
+
+__all__ = ['batch_request', 'BATCH_SIZE', 'JSONRPCError']
+
+BATCH_SIZE = 500  # requests per batch, keeps single responses reasonably small
+IPC_TIMEOUT = 10  # seconds, as in IPCProvider
+
+
+class JSONRPCError(Exception):
+    ...
+
+
+def _send_ipc(provider: IPCProvider, payload: bytes) -> bytes:
+    # Same socket and lock as IPCProvider.make_request, the response is read until it parses.
+    with provider._lock, provider._socket as sock:
+        try:
+            sock.sendall(payload)
+        except BrokenPipeError:
+            sock = provider._socket.reset()
+            sock.sendall(payload)
+        raw_response = b''
+        deadline = time.monotonic() + IPC_TIMEOUT
+        while True:
+            if time.monotonic() > deadline:
+                raise TimeoutError('No response to the batch request')
+            try:
+                chunk = sock.recv(64 * 1024)
+            except socket.timeout:
+                continue
+            if not chunk:
+                raise ConnectionError('IPC connection closed')
+            raw_response += chunk
+            try:
+                json.loads(raw_response)
+            except ValueError:
+                continue
+            return raw_response
+
+
+def _send_http(provider: HTTPProvider, payload: bytes) -> bytes:
+    return make_post_request(provider.endpoint_uri, payload, **provider.get_request_kwargs())
+
+
+def batch_request(provider, requests: list) -> list:
+    """
+    Send JSON-RPC requests as batches, one round trip per BATCH_SIZE requests.
+    :param provider: web3 IPCProvider or HTTPProvider
+    :param requests: [(method, params)]
+    :return: results in the order of requests, JSONRPCError instances for failed requests
+    """
+    if isinstance(provider, IPCProvider):
+        send = _send_ipc
+    elif isinstance(provider, HTTPProvider):
+        send = _send_http
+    else:
+        raise TypeError(f'Batch requests are not supported by {provider.__class__.__name__}')
+
+    results = []
+    for offset in range(0, len(requests), BATCH_SIZE):
+        batch = requests[offset:offset + BATCH_SIZE]
+        payload = json.dumps([
+            {"jsonrpc": "2.0", "method": method, "params": params, "id": i}
+            for i, (method, params) in enumerate(batch)
+        ]).encode('utf-8')
+        responses = json.loads(send(provider, payload))
+        if isinstance(responses, dict):  # the whole batch was rejected
+            raise JSONRPCError(responses.get('error'))
+        by_id = {response.get('id'): response for response in responses}
+        for i in range(len(batch)):
+            response = by_id.get(i, {'error': 'No response'})
+            if 'error' in response:
+                results.append(JSONRPCError(response['error']))
+            else:
+                results.append(response['result'])
+    return results
@@ -0,0 +1,105 @@
+import asyncio
+import contextlib
+import logging
+
+from .transactions import FailedTransaction
+
+__all__ = ['ReceiptWatcher']
+
+logger = logging.getLogger('memority')
+
+
+class ReceiptWatcher:
+    """
+    Wakes coroutines waiting for transactions. New block heads are followed through a block filter
+    on the node and receipts of all pending transactions are checked in one batch per new block,
+    so RPC load depends on the number of blocks, not on the number of waiters.
+    """
+    FILTER_POLL_INTERVAL = 1.0  # seconds
+
+    def __init__(self, get_w3, run, get_receipts) -> None:
+        """
+        :param get_w3: callable returning the current Web3 instance
+        :param run: coroutine function running a blocking web3 call, see run_w3
+        :param get_receipts: blocking callable returning receipts of tx hashes, None for pending ones
+        """
+        self._get_w3 = get_w3
+        self._run = run
+        self._get_receipts = get_receipts
+        self._pending = {}  # tx hash -> [futures]
+        self._unchecked = set()  # tx hashes added since the last check, they may be mined already
+        self._task = None
+
+    async def wait(self, tx_hash, timeout):
+        """
+        :return: receipt, None if the transaction is not mined in time
+        :raise FailedTransaction: the transaction is mined with a failed status
+        """
+        future = asyncio.get_event_loop().create_future()
+        self._pending.setdefault(tx_hash, []).append(future)
+        self._unchecked.add(tx_hash)
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._watch())
+        try:
+            receipt = await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            waiters = self._pending.get(tx_hash, [])
+            if future in waiters:
+                waiters.remove(future)
+                if not waiters:
+                    del self._pending[tx_hash]
+        if receipt.get('status') != 1:
+            logger.error(
+                f'Failed transaction | tx_hash: {tx_hash} | receipt: {receipt}',
+                extra={
+                    'stack': True,
+                }
+            )
+            raise FailedTransaction(f'Failed transaction | tx_hash: {tx_hash}')
+        return receipt
+
+    async def _watch(self):
+        filter_id = None
+        try:
+            while self._pending:
+                await asyncio.sleep(self.FILTER_POLL_INTERVAL)
+                try:
+                    if filter_id is None:
+                        filter_id = await self._run(self._new_block_filter)
+                        new_blocks = False
+                    else:
+                        new_blocks = bool(await self._run(self._get_w3().eth.getFilterChanges, filter_id))
+                except Exception as err:
+                    # the filter expired or the node is restarting: check all receipts, retry the filter next time
+                    logger.warning(f'Block filter failed | message: {err.__class__.__name__} {str(err)}')
+                    filter_id = None
+                    new_blocks = True
+                if new_blocks:
+                    await self._check(list(self._pending))
+                elif self._unchecked:
+                    await self._check([tx_hash for tx_hash in self._unchecked if tx_hash in self._pending])
+        finally:
+            if filter_id is not None:
+                with contextlib.suppress(Exception):
+                    await self._run(self._get_w3().eth.uninstallFilter, filter_id)
+
+    def _new_block_filter(self):
+        return self._get_w3().manager.request_blocking('eth_newBlockFilter', [])
+
+    async def _check(self, tx_hashes):
+        self._unchecked.difference_update(tx_hashes)
+        if not tx_hashes:
+            return
+        try:
+            receipts = await self._run(self._get_receipts, tx_hashes)
+        except Exception as err:
+            logger.warning(f'Receipts request failed | message: {err.__class__.__name__} {str(err)}')
+            self._unchecked.update(tx_hashes)
+            return
+        for tx_hash, receipt in zip(tx_hashes, receipts):
+            if receipt:
+                for future in self._pending.pop(tx_hash, []):
+                    if not future.done():
+                        future.set_result(receipt)
@@ -1,17 +1,29 @@
 import asyncio
+import contextlib
+import itertools
 import logging
 import os
 import pickle
 import platform
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
+from functools import partial, lru_cache
 
+from eth_abi import decode_abi
+from eth_abi.exceptions import DecodingError
 from solc import compile_source
 from web3 import Web3, IPCProvider, HTTPProvider
 from web3.contract import ConciseContract
 from web3.exceptions import BadFunctionCallOutput
+from web3.middleware.pythonic import receipt_formatter
+from web3.utils.abi import BASE_RETURN_NORMALIZERS, get_abi_output_types, map_abi_data
 
 from bugtracking import raven_client
 from settings import settings
+from .call_cache import ContractCallCache, cached_call
+from .json_rpc_batch import batch_request
+from .receipt_watcher import ReceiptWatcher
+from .transactions import TransactionManager
 
 logger = logging.getLogger('memority')
 
@@ -35,26 +47,51 @@ def create_w3():
 
 w3 = create_w3()
 
+# Web3 providers are blocking, so all RPCs of coroutines run on these threads
+# and the event loop keeps serving the hoster app while the node is slow.
+_w3_executor = ThreadPoolExecutor(max_workers=settings.w3_workers, thread_name_prefix='w3')
+
+
+async def run_w3(fn, *args, **kwargs):
+    """
+    Run a blocking web3 call (contract function, w3.eth method) on a w3 thread.
+    """
+    return await asyncio.get_event_loop().run_in_executor(_w3_executor, partial(fn, *args, **kwargs))
+
+
+def _get_block_number():
+    return w3.eth.blockNumber
+
+
+contract_call_cache = ContractCallCache(block_number=lambda: run_w3(_get_block_number))
+
+
+def _get_receipts(tx_hashes):
+    """
+    Receipts of many transactions in one batch request, None for pending ones.
+    """
+    try:
+        receipts = batch_request(w3.providers[0], [('eth_getTransactionReceipt', [h]) for h in tx_hashes])
+    except TypeError:  # provider without batch requests
+        receipts = []
+        for tx_hash in tx_hashes:
+            try:
+                receipts.append(w3.eth.getTransactionReceipt(tx_hash))
+            except ValueError:  # unknown transaction
+                receipts.append(None)
+        return receipts
+    return [receipt_formatter(r) if r and not isinstance(r, Exception) else None for r in receipts]
+
+
+receipt_watcher = ReceiptWatcher(get_w3=lambda: w3, run=run_w3, get_receipts=_get_receipts)
+
 
 async def wait_for_transaction_completion(tx_hash, max_tries=25):
-    while max_tries:
-        try:
-            tx_receipt = w3.eth.getTransactionReceipt(tx_hash)
-            if tx_receipt:
-                status = tx_receipt.get('status')
-                if status != 1:
-                    logger.error(
-                        f'Failed transaction | tx_hash: {tx_hash} | receipt: {tx_receipt}',
-                        extra={
-                            'stack': True,
-                        }
-                    )
-                    raise Exception(f'Failed transaction | tx_hash: {tx_hash}')
-                break
-        except ValueError:
-            print(f'pending transaction {tx_hash}')
-        await asyncio.sleep(5)
-        max_tries -= 1
+    """
+    :return: receipt, None if the transaction is not mined in max_tries * 5 seconds
+    :raise FailedTransaction: the transaction is mined with a failed status
+    """
+    return await receipt_watcher.wait(tx_hash, timeout=max_tries * 5)
 
 
 def import_private_key_to_eth(password, key=None):
@@ -81,12 +118,12 @@ async def ask_for_password():
     raise NotImplementedError
 
 
-async def _unlock_account():
+async def _unlock_account(duration=None):
     try:
         logger.info(f'Unlocking account | address: {settings.address}')
         password = await ask_for_password()
         address = settings.address
-        w3.personal.unlockAccount(address, password)
+        await run_w3(w3.personal.unlockAccount, address, password, duration)
     except Exception as err:
         raven_client.captureException()
         logger.error(f'Account unlocking failed | address: {settings.address} '
@@ -94,8 +131,7 @@ async def _unlock_account():
         raise
 
 
-def _lock_account():
-    w3.personal.lockAccount(settings.address)
+transaction_manager = TransactionManager(get_w3=lambda: w3, run=run_w3, unlock=_unlock_account)
 
 
 def _get_contract_address(contract_name):
@@ -113,6 +149,10 @@ def _get_contract_address(contract_name):
             return address
 
 
+# contract name -> interface, binaries are read and unpickled once per process
+_contract_interfaces = {}
+
+
 def _compile_contract(contract_name):
     logger.info(f'Compiling contract | name: {contract_name}')
     with open(_contract_sol_file(contract_name), 'r') as f:
@@ -124,16 +164,20 @@ def _compile_contract(contract_name):
     with open(_contract_bin_file(contract_name), 'wb') as f:
         pickle.dump(contract_interface, f, pickle.HIGHEST_PROTOCOL)
 
+    _contract_interfaces[contract_name] = contract_interface
     return contract_interface
 
 
 def _get_contract_interface(contract_name):
+    with contextlib.suppress(KeyError):
+        return _contract_interfaces[contract_name]
     contract_bin_file = _contract_bin_file(contract_name)
     if not os.path.isfile(contract_bin_file):
-        _compile_contract(contract_name)
+        return _compile_contract(contract_name)
     with open(contract_bin_file, 'rb') as f:
         contract_interface = pickle.load(f)
-        return contract_interface
+    _contract_interfaces[contract_name] = contract_interface
+    return contract_interface
 
 
 def _get_contract_instance(contract_name, address=None):
@@ -146,32 +190,34 @@ def _get_contract_instance(contract_name, address=None):
 
 
 async def _deploy_contract(contract_name, gas, args):
-    await _unlock_account()
     contract_interface = _get_contract_interface(contract_name)
 
     contract = w3.eth.contract(
         abi=contract_interface['abi'],
         bytecode=contract_interface['bin']
     )
-    tx_hash = contract.deploy(
-        transaction={'from': settings.address, 'gas': gas},
-        args=args
+    tx_hash = await transaction_manager.send(
+        lambda tx: contract.deploy(transaction=tx, args=args),
+        {'from': settings.address, 'gas': gas}
     )
     setattr(settings, f'{contract_name.lower()}_contract_creation_tx_hash', tx_hash)
     setattr(settings, f'{contract_name.lower()}_contract_address', '')
     # settings.dump()
-    _lock_account()
     return tx_hash
 
 
-def send_ether(*, from_=None, to, value):
+async def send_ether(*, from_=None, to, value):
     if not from_:
         from_ = settings.address
     logger.info(f'Sending ether | from: {from_} | to: {to} | value: {value}eth')
-    return w3.eth.sendTransaction({"from": from_, "to": to, "value": w3.toWei(value, 'ether'), 'gas': 1_000_000})
+    return await transaction_manager.send(
+        w3.eth.sendTransaction,
+        {"from": from_, "to": to, "value": w3.toWei(value, 'ether'), 'gas': 1_000_000}
+    )
 
 
 class Contract:
+    call_cache = contract_call_cache
 
     def __init__(self, contract_name, gas, deploy_args, address=None) -> None:
         super().__init__()
@@ -189,7 +235,7 @@ class Contract:
         logger.info(f'Deploying contract | name: {self.contract_name}')
         tx_hash = await _deploy_contract(self.contract_name, self.gas, self.deploy_args)
         await wait_for_transaction_completion(tx_hash)
-        address = _get_contract_address(self.contract_name)
+        address = await run_w3(_get_contract_address, self.contract_name)
         self.contract = _get_contract_instance(self.contract_name, address)
         logger.info(f'Deployed contract | name: {self.contract_name} | address: {address}')
         return address
@@ -202,6 +248,68 @@ class Contract:
             self.address = None
             self.contract = None
 
+    def batch_call(self, calls: list) -> list:
+        """
+        Several view calls in one JSON-RPC batch, decoded the same way as ConciseContract calls.
+        :param calls: [(contract function name, args)]
+        :return: results in the order of calls, BadFunctionCallOutput instances for failed calls
+        """
+        classic = self.contract._classic_contract
+        responses = batch_request(w3.providers[0], [
+            ('eth_call', [classic._prepare_transaction(fn_name=fn_name, fn_args=args), 'latest'])
+            for fn_name, args in calls
+        ])
+        results = []
+        for (fn_name, args), response in zip(calls, responses):
+            if isinstance(response, Exception):
+                results.append(BadFunctionCallOutput(str(response)))
+                continue
+            output_types = get_abi_output_types(classic._find_matching_fn_abi(fn_name, args))
+            try:
+                output_data = decode_abi(output_types, bytes.fromhex(response[2:]))
+            except DecodingError as err:
+                results.append(BadFunctionCallOutput(f'Could not decode {fn_name} return data | {err}'))
+                continue
+            normalized_data = map_abi_data(
+                itertools.chain(BASE_RETURN_NORMALIZERS, classic._return_data_normalizers),
+                output_types,
+                output_data
+            )
+            results.append(normalized_data[0] if len(normalized_data) == 1 else normalized_data)
+        return results
+
+    async def cached_batch_call(self, calls: list) -> list:
+        """
+        batch_call for methods decorated with cached_call: cached results are reused,
+        the rest is fetched in one batch and cached.
+        :param calls: [(cached method, contract function name, args)]
+        :raise BadFunctionCallOutput: if any of the calls failed
+        """
+        block = await self.call_cache.current_block() if any(c[0].per_block for c in calls) else None
+        results = [None] * len(calls)
+        missing = []
+        for i, (method, _, args) in enumerate(calls):
+            hit, results[i] = self.call_cache.get(
+                method.key(self, *args),
+                block if method.per_block else None
+            )
+            if not hit:
+                missing.append(i)
+        if missing:
+            fetched = await run_w3(self.batch_call, [calls[i][1:] for i in missing])
+            for i, value in zip(missing, fetched):
+                if isinstance(value, Exception):
+                    raise value
+                method, _, args = calls[i]
+                self.call_cache.put(
+                    method.key(self, *args),
+                    value,
+                    method.ttl,
+                    block if method.per_block else None
+                )
+                results[i] = value
+        return results
+
 
 class TokenContract(Contract):
 
@@ -211,38 +319,43 @@ class TokenContract(Contract):
             gas=4_000_000,
             deploy_args=[1000, w3.toWei('0.01', 'ether')]
         )
+        self._refill_lock = asyncio.Lock()
 
-    def get_token_price(self):
+    async def get_token_price(self):
         """
         Price of 1 WMMR
         :return: <int>
         """
-        return self.contract.tokenPrice()
+        return await run_w3(self.contract.tokenPrice)
 
-    def get_mmr_balance(self, address=None):
+    async def get_mmr_balance(self, address=None):
         if not address:
             address = settings.address
         try:
-            return self.wmmr_to_mmr(self.contract.balanceOf(address))
+            return await self.wmmr_to_mmr(await run_w3(self.contract.balanceOf, address))
         except BadFunctionCallOutput:
             return 0
 
     @staticmethod
-    def get_wei_balance(address=None):
+    async def get_wei_balance(address=None):
         if not address:
             address = settings.address
-        return w3.eth.getBalance(address)
+        return await run_w3(w3.eth.getBalance, address)
 
-    def time_to_pay(self, file_hash) -> bool:
-        return self.contract.timeToPay(file_hash)
+    async def time_to_pay(self, file_hash) -> bool:
+        return await run_w3(self.contract.timeToPay, file_hash)
+
+    @cached_call(ttl=60, per_block=True)
+    async def _deposits(self, owner_contract_address, file_hash):
+        return await run_w3(self.contract.deposits, owner_contract_address, file_hash)
 
     async def get_deposit(self, *, owner_contract_address=None, file_hash, ping=False):
         if not owner_contract_address:
             owner_contract_address = settings.client_contract_address
-        deposit = self.contract.deposits(owner_contract_address, file_hash)
+        deposit = await self._deposits(owner_contract_address, file_hash)
         if ping and not deposit:
             for i in range(5):
-                deposit = self.contract.deposits(owner_contract_address, file_hash)
+                deposit = await run_w3(self.contract.deposits, owner_contract_address, file_hash)
                 if deposit:
                     break
                 else:
@@ -252,32 +365,35 @@ class TokenContract(Contract):
 
     async def request_payout(self, owner_contract_address, file_hash) -> int:
         await self.refill()
-        await _unlock_account()
-        amount = self.contract.requestPayout(
-            owner_contract_address,
-            file_hash,
-            transact={'from': settings.address, 'gas': 1_000_000}
+        amount = await transaction_manager.send(
+            lambda tx: self.contract.requestPayout(owner_contract_address, file_hash, transact=tx),
+            {'from': settings.address, 'gas': 1_000_000}
         )
-        _lock_account()
         # ToDo: payout history to db
         return amount
 
-    def mmr_to_wmmr(self, value):
-        return int(Decimal(value) * Decimal(10) ** self.contract.decimals())
+    @cached_call(ttl=3600)
+    async def decimals(self):
+        return await run_w3(self.contract.decimals)
+
+    async def mmr_to_wmmr(self, value):
+        return int(Decimal(value) * Decimal(10) ** await self.decimals())
 
-    def wmmr_to_mmr(self, value):
-        return float(Decimal(value) * Decimal(10) ** -self.contract.decimals())
+    async def wmmr_to_mmr(self, value):
+        return float(Decimal(value) * Decimal(10) ** -await self.decimals())
 
-    @property
-    def tokens_per_byte_hour(self):
-        return self.contract.tokensPerByteHour()
+    @cached_call(ttl=600)
+    async def get_tokens_per_byte_hour(self):
+        return await run_w3(self.contract.tokensPerByteHour)
 
     async def refill(self):
-        if w3.fromWei(w3.eth.getBalance(settings.address), 'ether') < 0.1:
-            await _unlock_account()
-            tx_hash = self.contract.refill(transact={'from': settings.address, 'gas': 200_000})
-            await wait_for_transaction_completion(tx_hash)
-            _lock_account()
+        async with self._refill_lock:  # one refill for concurrent transactions
+            if w3.fromWei(await self.get_wei_balance(), 'ether') < 0.1:
+                tx_hash = await transaction_manager.send(
+                    lambda tx: self.contract.refill(transact=tx),
+                    {'from': settings.address, 'gas': 200_000}
+                )
+                await wait_for_transaction_completion(tx_hash)
 
 
 class MemoDBContract(Contract):
@@ -295,25 +411,44 @@ class MemoDBContract(Contract):
             address = settings.address
         logger.info(f'Adding host to Token contract | ip: {ip} | address: {address}')
         await token_contract.refill()
-        await _unlock_account()
-        tx_hash = self.contract.updateHost(ip, transact={'from': address, 'gas': 1_000_000})
-        _lock_account()
+        tx_hash = await transaction_manager.send(
+            lambda tx: self.contract.updateHost(ip, transact=tx),
+            {'from': address, 'gas': 1_000_000}
+        )
+        self.call_cache.invalidate(self.address)
         if wait:
             await wait_for_transaction_completion(tx_hash)
         logger.info(f'Successfully added host to Token contract | ip: {ip} | address: {address}')
 
-    def get_hosts(self):
+    async def get_hosts(self):
         logger.info('Get host list from Token contract')
-        return self.contract.getHosts()
+        return await run_w3(self.contract.getHosts)
 
-    def get_host_ip(self, address):
+    @cached_call(ttl=600)
+    async def _get_host_ip(self, address):
+        try:
+            return (await run_w3(self.contract.getHostIp, address)).strip('\x00')
+        except BadFunctionCallOutput:
+            return None
+
+    async def get_host_ip(self, address):
         if not address:
             return None
         logger.info(f'Get host ip from Token contract | address: {address}')
+        return await self._get_host_ip(address)
+
+    async def get_host_ips(self, addresses: list) -> list:
+        """
+        get_host_ip for many hosts in one batch request
+        """
+        logger.info(f'Get host ips from Token contract | hosts: {len(addresses)}')
         try:
-            return self.contract.getHostIp(address).strip('\x00')
+            ips = await self.cached_batch_call(
+                [(MemoDBContract._get_host_ip, 'getHostIp', (a,)) for a in addresses]
+            )
         except BadFunctionCallOutput:
-            return None
+            return [await self.get_host_ip(address) for address in addresses]
+        return [ip.strip('\x00') for ip in ips]
 
 
 class ClientContract(Contract):
@@ -332,17 +467,14 @@ class ClientContract(Contract):
         :param file_hash: file hash
         :return: None
         """
-        value = token_contract.mmr_to_wmmr(value)
+        value = await token_contract.mmr_to_wmmr(value)
         await token_contract.refill()
-        await _unlock_account()
-        try:
-            tx_hash = self.contract.makeDeposit(
-                value, file_hash,
-                transact={'from': settings.address, 'gas': 1_000_000})
-        except Exception:
-            raise
+        tx_hash = await transaction_manager.send(
+            lambda tx: self.contract.makeDeposit(value, file_hash, transact=tx),
+            {'from': settings.address, 'gas': 1_000_000}
+        )
         await wait_for_transaction_completion(tx_hash)
-        _lock_account()
+        self.call_cache.invalidate(token_contract.address, '_deposits')
 
     async def add_host_to_file(self, file_hash):
         """
@@ -351,30 +483,26 @@ class ClientContract(Contract):
         :return: None
         """
         await token_contract.refill()
-        await _unlock_account()
-        tx_hash = self.contract.addHostToFile(
-            file_hash,
-            transact={'from': settings.address, 'gas': 1_000_000}
+        tx_hash = await transaction_manager.send(
+            lambda tx: self.contract.addHostToFile(file_hash, transact=tx),
+            {'from': settings.address, 'gas': 1_000_000}
         )
-        _lock_account()
         await wait_for_transaction_completion(tx_hash)
+        self.call_cache.invalidate(self.address, 'get_file_hosts')
 
     async def vote_offline(self, address_of_offline, file_hash):
         logger.info(f'Vote offline | file: {file_hash} | host: {address_of_offline}')
         await token_contract.refill()
-        await _unlock_account()
-        self.contract.voteOffline(
-            address_of_offline,
-            file_hash,
-            transact={'from': settings.address, 'gas': 1_000_000}
+        await transaction_manager.send(
+            lambda tx: self.contract.voteOffline(address_of_offline, file_hash, transact=tx),
+            {'from': settings.address, 'gas': 1_000_000}
         )
-        _lock_account()
 
-    def need_copy(self, file_hash) -> bool:
-        return self.contract.needCopy(file_hash)
+    async def need_copy(self, file_hash) -> bool:
+        return await run_w3(self.contract.needCopy, file_hash)
 
-    def need_replace(self, old_host_address, file_hash) -> bool:
-        return self.contract.needReplace(old_host_address, file_hash)
+    async def need_replace(self, old_host_address, file_hash) -> bool:
+        return await run_w3(self.contract.needReplace, old_host_address, file_hash)
 
     async def add_hosts(self, file_hash, file_name, file_size, hosts, signature,
                         vendor=None, from_address=None):
@@ -384,51 +512,83 @@ class ClientContract(Contract):
             from_address = settings.address
         logger.info(f'Adding file hosts to Client contract | file: {file_hash} | address: {from_address}')
         await token_contract.refill()
-        await _unlock_account()
-        tx_hash = self.contract.newFile(
-            file_hash,
-            file_name,
-            file_size,
-            vendor,
-            hosts,
-            transact={'from': from_address, 'gas': 1_000_000}
+        tx_hash = await transaction_manager.send(
+            lambda tx: self.contract.newFile(file_hash, file_name, file_size, vendor, hosts, transact=tx),
+            {'from': from_address, 'gas': 1_000_000}
         )
         logger.info(f'Added file hosts to Client contract | file: {file_hash} | address: {from_address}')
         await wait_for_transaction_completion(tx_hash)
+        self.call_cache.invalidate(self.address)
 
-    def get_files(self):
+    @cached_call(ttl=60, per_block=True)
+    async def get_files(self):
         logger.info('Get file list from Client contract')
-        return self.contract.getFiles()
+        return await run_w3(self.contract.getFiles)
 
-    def get_file_name(self, file_hash):
+    @cached_call(ttl=3600)
+    async def get_file_name(self, file_hash):
         logger.info(f'Get file name from Client contract | file: {file_hash}')
-        return self.contract.getFileName(file_hash)
+        return await run_w3(self.contract.getFileName, file_hash)
 
-    def get_file_size(self, file_hash):
+    @cached_call(ttl=3600)
+    async def get_file_size(self, file_hash):
         logger.info(f'Get file size from Client contract | file: {file_hash}')
         try:
-            return self.contract.getFileSize(file_hash)
+            return await run_w3(self.contract.getFileSize, file_hash)
         except BadFunctionCallOutput:
             return 0
 
-    def get_file_hosts(self, file_hash):
+    @cached_call(ttl=60, per_block=True)
+    async def get_file_hosts(self, file_hash):
         logger.info(f'Get file hosts from Client contract | file: {file_hash}')
-        return self.contract.getFileHosts(file_hash)
+        return await run_w3(self.contract.getFileHosts, file_hash)
+
+    async def get_files_info(self, file_hashes: list) -> dict:
+        """
+        Names and hosts of many files in one batch request
+        :return: {file_hash: (name, hosts)}
+        """
+        logger.info(f'Get file names and hosts from Client contract | files: {len(file_hashes)}')
+        try:
+            results = await self.cached_batch_call([
+                call
+                for file_hash in file_hashes
+                for call in [
+                    (ClientContract.get_file_name, 'getFileName', (file_hash,)),
+                    (ClientContract.get_file_hosts, 'getFileHosts', (file_hash,)),
+                ]
+            ])
+        except BadFunctionCallOutput:
+            return {
+                file_hash: (await self.get_file_name(file_hash), await self.get_file_hosts(file_hash))
+                for file_hash in file_hashes
+            }
+        return {
+            file_hash: (results[2 * i], results[2 * i + 1])
+            for i, file_hash in enumerate(file_hashes)
+        }
 
     async def replace_host(self, file_hash, old_host_address, from_address=None):
         if not from_address:
             from_address = settings.address
         await token_contract.refill()
-        await _unlock_account()
         logger.info(f'Replace file host in Client contract | file: {file_hash} '
                     f'| old: {old_host_address} | new: {from_address}')
-        tx_hash = self.contract.replaceHost(
-            file_hash,
-            old_host_address,
-            transact={'from': from_address, 'gas': 1_000_000}
+        tx_hash = await transaction_manager.send(
+            lambda tx: self.contract.replaceHost(file_hash, old_host_address, transact=tx),
+            {'from': from_address, 'gas': 1_000_000}
         )
-        _lock_account()
         await wait_for_transaction_completion(tx_hash)
+        self.call_cache.invalidate(self.address, 'get_file_hosts')
+
+
+@lru_cache(maxsize=1024)
+def get_client_contract(address) -> ClientContract:
+    """
+    Pooled ClientContract of another client, e.g. the owner of a hosted file.
+    The pool is cleared with get_client_contract.cache_clear() when w3 is recreated.
+    """
+    return ClientContract(address=address)
 
 
 token_contract = TokenContract()
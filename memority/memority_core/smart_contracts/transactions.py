@@ -0,0 +1,70 @@
+import asyncio
+import time
+
+__all__ = ['TransactionManager', 'FailedTransaction']
+
+
+class FailedTransaction(Exception):
+    ...
+
+
+class TransactionManager:
+    """
+    Sends transactions back to back: nonces are assigned locally and the account stays unlocked
+    for UNLOCK_WINDOW seconds instead of being unlocked and locked around every transaction.
+    Receipts are awaited with ReceiptWatcher.
+    """
+    UNLOCK_WINDOW = 300  # seconds
+
+    def __init__(self, get_w3, run, unlock) -> None:
+        """
+        :param get_w3: callable returning the current Web3 instance
+        :param run: coroutine function running a blocking web3 call, see run_w3
+        :param unlock: coroutine function unlocking the account, takes the unlock duration
+        """
+        self._get_w3 = get_w3
+        self._run = run
+        self._unlock = unlock
+        self._unlocked_until = 0
+        self._unlock_lock = asyncio.Lock()
+        self._nonces = {}  # address -> next nonce
+        self._nonce_lock = asyncio.Lock()
+
+    async def unlock(self):
+        async with self._unlock_lock:
+            if time.monotonic() < self._unlocked_until:
+                return
+            await self._unlock(self.UNLOCK_WINDOW)
+            self._unlocked_until = time.monotonic() + self.UNLOCK_WINDOW - 10  # margin for the request time
+
+    def reset(self):
+        """
+        Forget nonces and the unlock window, e.g. after the account or the node changed.
+        """
+        self._nonces.clear()
+        self._unlocked_until = 0
+
+    async def send(self, send_fn, transaction: dict):
+        """
+        :param send_fn: blocking callable sending the transaction it is given,
+            e.g. `lambda tx: contract.someFunction(arg, transact=tx)`
+        :param transaction: transaction without nonce, 'from' is required
+        :return: tx hash
+        """
+        await self.unlock()
+        address = transaction['from']
+        async with self._nonce_lock:  # the node gets transactions in nonce order
+            if address not in self._nonces:
+                self._nonces[address] = await self._run(
+                    self._get_w3().eth.getTransactionCount, address, 'pending'
+                )
+            nonce = self._nonces[address]
+            try:
+                tx_hash = await self._run(send_fn, dict(transaction, nonce=nonce))
+            except Exception:
+                # resync the nonce and unlock again on the next transaction, e.g. the node restarted
+                self._nonces.pop(address, None)
+                self._unlocked_until = 0
+                raise
+            self._nonces[address] = nonce + 1
+        return tx_hash
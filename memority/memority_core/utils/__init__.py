@@ -2,12 +2,25 @@ import getpass
 import os
 
 from settings import settings
-from .encryption import compute_hash, verify_signature, encrypt, decrypt, sign, InvalidSignature, DecryptionError
+from .encryption import compute_hash, verify_signature, encrypt, decrypt, sign, InvalidSignature, DecryptionError, \
+    compute_file_hash, encrypt_chunk, StreamDecryptor, hash_stream, signature_stream, sign_digest, CHUNKED_MAGIC, \
+    encrypt_async, decrypt_async, sign_async, sign_digest_async, encrypt_chunk_async, compute_hash_async, \
+    compute_file_hash_async, invalidate_key_cache
+from .crypto_executor import run_crypto, shutdown_crypto_executor
 from .get_ip import get_ip
+from .peer_http import get_peer_session, close_peer_session, setup_peer_session
+from .merkle import MERKLE_BLOCK_SIZE, build_merkle_index, read_merkle_root, merkle_proof, verify_merkle_proof
 
 __all__ = ['check_first_run', 'ask_for_password',
            'compute_hash', 'verify_signature', 'encrypt', 'decrypt', 'sign', 'InvalidSignature', 'DecryptionError',
-           'get_ip']
+           'compute_file_hash', 'encrypt_chunk', 'StreamDecryptor', 'hash_stream', 'signature_stream', 'sign_digest',
+           'CHUNKED_MAGIC',
+           'encrypt_async', 'decrypt_async', 'sign_async', 'sign_digest_async', 'encrypt_chunk_async',
+           'compute_hash_async', 'compute_file_hash_async', 'run_crypto', 'shutdown_crypto_executor',
+           'invalidate_key_cache',
+           'get_ip',
+           'get_peer_session', 'close_peer_session', 'setup_peer_session',
+           'MERKLE_BLOCK_SIZE', 'build_merkle_index', 'read_merkle_root', 'merkle_proof', 'verify_merkle_proof']
 
 
 def check_first_run():
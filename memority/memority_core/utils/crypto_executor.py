@@ -0,0 +1,36 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+from settings import settings
+
+__all__ = ['run_crypto', 'shutdown_crypto_executor']
+
+_executor = None
+
+
+def _get_executor():
+    """
+    Pool for CPU-bound work (encryption, signing, hashing), configured by
+    `crypto_executor` (thread | process) and `crypto_workers` settings.
+    Functions sent to a process pool must be module-level and get all key material as arguments.
+    """
+    global _executor
+    if _executor is None:
+        workers = settings.crypto_workers or None
+        if settings.crypto_executor == 'process':
+            _executor = ProcessPoolExecutor(max_workers=workers)
+        else:
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='crypto')
+    return _executor
+
+
+async def run_crypto(fn, *args, **kwargs):
+    return await asyncio.get_event_loop().run_in_executor(_get_executor(), partial(fn, *args, **kwargs))
+
+
+def shutdown_crypto_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
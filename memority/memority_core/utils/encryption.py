@@ -1,12 +1,31 @@
 import base64
 import hashlib
+import struct
+from functools import lru_cache
 
 from cryptography.fernet import Fernet, InvalidToken
 from ecdsa import SigningKey, SECP256k1, BadSignatureError, VerifyingKey
 
 from settings import settings
+from .crypto_executor import run_crypto
 
-__all__ = ["encrypt", "decrypt", "compute_hash", "sign", "verify_signature", "InvalidSignature", "DecryptionError"]
+__all__ = ["encrypt", "decrypt", "compute_hash", "sign", "verify_signature", "InvalidSignature", "DecryptionError",
+           "compute_file_hash", "encrypt_chunk", "StreamDecryptor", "hash_stream", "signature_stream", "sign_digest",
+           "CHUNKED_MAGIC",
+           "encrypt_async", "decrypt_async", "sign_async", "sign_digest_async", "encrypt_chunk_async",
+           "compute_hash_async", "compute_file_hash_async", "invalidate_key_cache"]
+
+# Chunk-framed ciphertext: CHUNKED_MAGIC followed by frames of
+# <4-byte big-endian token length><Fernet token>.
+# Every token authenticates <8-byte chunk index><1-byte last flag><data>,
+# so reordered, dropped or truncated frames fail decryption.
+CHUNKED_MAGIC = b'MMRC1\n'
+_FRAME_HEADER = struct.Struct('>I')
+_CHUNK_HEADER = struct.Struct('>Q?')
+
+
+# Account key material, read from the encrypted settings once per unlock.
+_key_cache = {}
 
 
 class InvalidSignature(Exception):
@@ -17,12 +36,64 @@ class DecryptionError(Exception):
     ...
 
 
-def sign(data: bytes):
-    sk = SigningKey.from_string(bytes.fromhex(settings.private_key), curve=SECP256k1)
-    signature = sk.sign(data)
+def invalidate_key_cache():
+    """
+    Forget cached account key material, must be called whenever the account keys
+    or the settings password change.
+    """
+    _key_cache.clear()
+
+
+def _account_secret(name):
+    value = _key_cache.get(name)
+    if not value:
+        value = getattr(settings, name)
+        if value:
+            _key_cache[name] = value
+    return value
+
+
+@lru_cache(maxsize=4)
+def _signing_key(private_key: str):
+    return SigningKey.from_string(bytes.fromhex(private_key), curve=SECP256k1)
+
+
+@lru_cache(maxsize=16)
+def _fernet(key: bytes):
+    return Fernet(key)
+
+
+def _sign_with_key(private_key: str, data: bytes):
+    signature = _signing_key(private_key).sign(data)
+    return signature.hex()
+
+
+def _sign_digest_with_key(private_key: str, digest: bytes):
+    signature = _signing_key(private_key).sign_digest(digest)
     return signature.hex()
 
 
+def sign(data: bytes):
+    return _sign_with_key(_account_secret('private_key'), data)
+
+
+async def sign_async(data: bytes):
+    return await run_crypto(_sign_with_key, _account_secret('private_key'), data)
+
+
+def sign_digest(digest: bytes):
+    """
+    Sign a precomputed digest, see signature_stream
+    :param digest: <bytes> digest of data to sign
+    :return: <str> hex signature, same as sign(data)
+    """
+    return _sign_digest_with_key(_account_secret('private_key'), digest)
+
+
+async def sign_digest_async(digest: bytes):
+    return await run_crypto(_sign_digest_with_key, _account_secret('private_key'), digest)
+
+
 def verify_signature(data: bytes, signature: str, public_key: str):
     vk = VerifyingKey.from_string(bytes.fromhex(public_key), curve=SECP256k1)
     try:
@@ -43,7 +114,27 @@ def get_encryption_key(password=None):
             password = password[:32]
         return base64.urlsafe_b64encode(bytes(password, 'utf-8'))
     else:
-        return base64.urlsafe_b64encode(bytes(settings.encryption_key, 'utf-8'))
+        return base64.urlsafe_b64encode(bytes(_account_secret('encryption_key'), 'utf-8'))
+
+
+def _encrypt_with_key(key: bytes, data):
+    fernet = _fernet(key)
+    cipher_text = fernet.encrypt(data)
+    return cipher_text
+
+
+def _decrypt_with_key(key: bytes, cipher_text):
+    fernet = _fernet(key)
+    try:
+        data = fernet.decrypt(cipher_text)
+    except InvalidToken as err:
+        raise DecryptionError(str(err))
+    return data
+
+
+def _encrypt_chunk_with_key(key: bytes, data: bytes, index: int, last: bool) -> bytes:
+    token = _encrypt_with_key(key, _CHUNK_HEADER.pack(index, last) + data)
+    return _FRAME_HEADER.pack(len(token)) + token
 
 
 def encrypt(data, password=None):
@@ -52,9 +143,11 @@ def encrypt(data, password=None):
     :param data: <bytes> data to encrypt
     :return: <bytes>
     """
-    fernet = Fernet(get_encryption_key(password))
-    cipher_text = fernet.encrypt(data)
-    return cipher_text
+    return _encrypt_with_key(get_encryption_key(password), data)
+
+
+async def encrypt_async(data, password=None):
+    return await run_crypto(_encrypt_with_key, get_encryption_key(password), data)
 
 
 def decrypt(cipher_text, password=None):
@@ -63,13 +156,149 @@ def decrypt(cipher_text, password=None):
     :param cipher_text: <bytes>
     :return: <bytes>
     """
-    fernet = Fernet(get_encryption_key(password))
-    try:
-        data = fernet.decrypt(cipher_text)
-    except InvalidToken as err:
-        raise DecryptionError(str(err))
-    return data
+    return _decrypt_with_key(get_encryption_key(password), cipher_text)
+
+
+async def decrypt_async(cipher_text, password=None):
+    return await run_crypto(_decrypt_with_key, get_encryption_key(password), cipher_text)
+
+
+def encrypt_chunk(data: bytes, index: int, last: bool, password=None) -> bytes:
+    """
+    Encrypt one segment of a chunk-framed ciphertext
+    :param data: <bytes> plain segment
+    :param index: <int> segment position in the stream
+    :param last: <bool> whether this is the final segment
+    :return: <bytes> frame
+    """
+    return _encrypt_chunk_with_key(get_encryption_key(password), data, index, last)
+
+
+async def encrypt_chunk_async(data: bytes, index: int, last: bool, password=None) -> bytes:
+    return await run_crypto(_encrypt_chunk_with_key, get_encryption_key(password), data, index, last)
+
+
+class StreamDecryptor:
+    """
+    Incremental decryption of ciphertext received in arbitrary pieces.
+    Chunk-framed ciphertext (see encrypt_chunk) is decrypted frame by frame,
+    legacy single-token ciphertext is buffered and decrypted in finalize().
+    """
+
+    def __init__(self, password=None) -> None:
+        self.password = password
+        self.chunked = None
+        self._buffer = bytearray()
+        self._index = 0
+        self._finished = False
+
+    def _feed(self, data: bytes) -> list:
+        """
+        :return: complete Fernet tokens buffered so far
+        """
+        self._buffer += data
+        if self.chunked is None:
+            if len(self._buffer) < len(CHUNKED_MAGIC):
+                return []
+            self.chunked = self._buffer.startswith(CHUNKED_MAGIC)
+            if self.chunked:
+                del self._buffer[:len(CHUNKED_MAGIC)]
+        tokens = []
+        while self.chunked and len(self._buffer) >= _FRAME_HEADER.size:
+            token_len, = _FRAME_HEADER.unpack_from(self._buffer)
+            frame_end = _FRAME_HEADER.size + token_len
+            if len(self._buffer) < frame_end:
+                break
+            tokens.append(bytes(self._buffer[_FRAME_HEADER.size:frame_end]))
+            del self._buffer[:frame_end]
+        return tokens
+
+    def _unframe(self, chunk: bytes) -> bytes:
+        if self._finished:
+            raise DecryptionError('Data after the last chunk')
+        index, last = _CHUNK_HEADER.unpack_from(chunk)
+        if index != self._index:
+            raise DecryptionError(f'Unexpected chunk | expected: {self._index} | got: {index}')
+        self._index += 1
+        self._finished = last
+        return chunk[_CHUNK_HEADER.size:]
+
+    def _check_complete(self):
+        if self._buffer or not self._finished:
+            raise DecryptionError('Truncated chunked ciphertext')
+
+    def update(self, data: bytes) -> bytes:
+        """
+        :param data: <bytes> next piece of ciphertext
+        :return: <bytes> plain data available so far
+        """
+        return b''.join(self._unframe(decrypt(token, self.password)) for token in self._feed(data))
+
+    async def update_async(self, data: bytes) -> bytes:
+        plain = []
+        for token in self._feed(data):
+            plain.append(self._unframe(await decrypt_async(token, self.password)))
+        return b''.join(plain)
+
+    def finalize(self) -> bytes:
+        """
+        :return: <bytes> remaining plain data
+        :raise DecryptionError: if the ciphertext is truncated
+        """
+        if not self.chunked:
+            return decrypt(bytes(self._buffer), self.password)
+        self._check_complete()
+        return b''
+
+    async def finalize_async(self) -> bytes:
+        if not self.chunked:
+            return await decrypt_async(bytes(self._buffer), self.password)
+        self._check_complete()
+        return b''
 
 
 def compute_hash(data) -> str:
     return hashlib.md5(data).hexdigest()
+
+
+def compute_file_hash(path, from_: int, to_: int, block_size=64 * 1024) -> str:
+    """
+    compute_hash of the file contents [from_:to_) without reading the whole file
+    :param block_size: <int> max bytes read at once
+    :return: same as compute_hash(body[from_:to_])
+    """
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        f.seek(from_)
+        remaining = to_ - from_
+        while remaining > 0:
+            block = f.read(min(block_size, remaining))
+            if not block:
+                break
+            md5.update(block)
+            remaining -= len(block)
+    return md5.hexdigest()
+
+
+async def compute_hash_async(data) -> str:
+    return await run_crypto(compute_hash, data)
+
+
+async def compute_file_hash_async(path, from_: int, to_: int) -> str:
+    return await run_crypto(compute_file_hash, path, from_, to_)
+
+
+def hash_stream():
+    """
+    Incremental counterpart of compute_hash
+    :return: hashlib object, hexdigest() equals compute_hash(all data)
+    """
+    return hashlib.md5()
+
+
+def signature_stream():
+    """
+    Incremental counterpart of sign: sign_digest(stream.digest()) equals sign(all data)
+    :return: hashlib object (ecdsa default hashfunc)
+    """
+    return hashlib.sha1()
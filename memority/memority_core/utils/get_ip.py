@@ -2,7 +2,7 @@ import asyncio
 from collections import namedtuple
 from concurrent.futures import FIRST_COMPLETED
 
-import aiohttp
+from .peer_http import get_peer_session, close_peer_session
 
 Service = namedtuple('Service', ('name', 'url', 'ip_attr'))
 
@@ -13,10 +13,9 @@ SERVICES = (
 
 
 async def fetch_ip(service):
-    async with aiohttp.ClientSession() as session:
-        async with session.get(service.url) as response:
-            json_response = await response.json()
-            ip = json_response[service.ip_attr]
+    async with get_peer_session().get(service.url) as response:
+        json_response = await response.json()
+        ip = json_response[service.ip_attr]
 
     return ip
 
@@ -37,4 +36,5 @@ async def get_ip():
 if __name__ == '__main__':
     ioloop = asyncio.get_event_loop()
     ioloop.run_until_complete(get_ip())
+    ioloop.run_until_complete(close_peer_session())
     ioloop.close()
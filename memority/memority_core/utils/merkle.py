@@ -0,0 +1,107 @@
+import hashlib
+import os
+import struct
+
+__all__ = ['MERKLE_BLOCK_SIZE', 'build_merkle_index', 'read_merkle_root', 'merkle_proof', 'verify_merkle_proof']
+
+# Part of the hoster protocol: all hosters must use the same block size.
+MERKLE_BLOCK_SIZE = 16 * 1024
+
+# Index file: header, then all tree levels from leaves up to the root, 32-byte digests each.
+_MAGIC = b'MMRM1'
+_HEADER = struct.Struct('>5sIQ')  # magic, block size, leaf count
+_DIGEST_SIZE = 32
+
+
+def _leaf_hash(block: bytes) -> bytes:
+    return hashlib.sha256(b'\x00' + block).digest()
+
+
+def _node_hash(left: bytes, right: bytes) -> bytes:
+    return hashlib.sha256(b'\x01' + left + right).digest()
+
+
+def _level_sizes(leaf_count):
+    sizes = [leaf_count]
+    while sizes[-1] > 1:
+        sizes.append((sizes[-1] + 1) // 2)
+    return sizes
+
+
+def build_merkle_index(path, index_path, block_size=MERKLE_BLOCK_SIZE) -> bytes:
+    """
+    Hash file blocks into a Merkle tree and persist all its levels.
+    An odd node at the end of a level is paired with itself.
+    :return: <bytes> root
+    """
+    level = []
+    with open(path, 'rb') as f:
+        block = f.read(block_size)
+        while True:
+            level.append(_leaf_hash(block))
+            block = f.read(block_size)
+            if not block:
+                break
+
+    tmp_path = f'{index_path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEADER.pack(_MAGIC, block_size, len(level)))
+        f.write(b''.join(level))
+        while len(level) > 1:
+            if len(level) % 2:
+                level.append(level[-1])
+            level = [_node_hash(level[i], level[i + 1]) for i in range(0, len(level), 2)]
+            f.write(b''.join(level))
+    os.replace(tmp_path, index_path)
+    return level[0]
+
+
+def _read_header(f):
+    magic, block_size, leaf_count = _HEADER.unpack(f.read(_HEADER.size))
+    if magic != _MAGIC:
+        raise ValueError('Invalid Merkle index')
+    return block_size, leaf_count
+
+
+def read_merkle_root(index_path) -> (bytes, int):
+    """
+    :return: root, leaf count
+    """
+    with open(index_path, 'rb') as f:
+        _, leaf_count = _read_header(f)
+        f.seek(-_DIGEST_SIZE, os.SEEK_END)
+        return f.read(_DIGEST_SIZE), leaf_count
+
+
+def merkle_proof(path, index_path, leaf: int) -> (bytes, list):
+    """
+    Read one block and its authentication path: O(log n) digest reads, one block read.
+    :return: block, sibling digests from the leaf level up
+    """
+    with open(index_path, 'rb') as index:
+        block_size, leaf_count = _read_header(index)
+        if not 0 <= leaf < leaf_count:
+            raise ValueError(f'Leaf out of range | leaf: {leaf} | leaves: {leaf_count}')
+        auth_path = []
+        level_offset = _HEADER.size
+        node = leaf
+        for level_size in _level_sizes(leaf_count)[:-1]:
+            sibling = node ^ 1 if node ^ 1 < level_size else node
+            index.seek(level_offset + sibling * _DIGEST_SIZE)
+            auth_path.append(index.read(_DIGEST_SIZE))
+            level_offset += level_size * _DIGEST_SIZE
+            node //= 2
+    with open(path, 'rb') as f:
+        f.seek(leaf * block_size)
+        block = f.read(block_size)
+    return block, auth_path
+
+
+def verify_merkle_proof(root: bytes, leaf_count: int, leaf: int, block: bytes, auth_path: list) -> bool:
+    if not 0 <= leaf < leaf_count or len(auth_path) != len(_level_sizes(leaf_count)) - 1:
+        return False
+    node = _leaf_hash(block)
+    for sibling in auth_path:
+        node = _node_hash(node, sibling) if leaf % 2 == 0 else _node_hash(sibling, node)
+        leaf //= 2
+    return node == root
@@ -0,0 +1,45 @@
+import aiohttp
+
+from settings import settings
+
+__all__ = ['get_peer_session', 'close_peer_session', 'setup_peer_session']
+
+_session = None
+
+
+def get_peer_session() -> aiohttp.ClientSession:
+    """
+    Session shared by all requests to other hosters, so that connections to a peer are kept alive and reused.
+    Pool size, connections per peer, DNS cache and timeouts are configured by `peer_http_*` settings.
+    Created on first use, must not be closed by callers, see close_peer_session.
+    """
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=settings.peer_http_connections,
+            limit_per_host=settings.peer_http_connections_per_host,
+            keepalive_timeout=settings.peer_http_keepalive,
+            use_dns_cache=True,
+            ttl_dns_cache=settings.peer_http_dns_ttl
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=None,  # file bodies are streamed, a response may take long as a whole
+            sock_connect=settings.peer_http_connect_timeout,
+            sock_read=settings.peer_http_read_timeout
+        )
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    return _session
+
+
+async def close_peer_session(app=None):
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+def setup_peer_session(app):
+    """
+    Close the shared session with the app, the renter and the hoster app both use it.
+    """
+    app.on_cleanup.append(close_peer_session)